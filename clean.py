@@ -0,0 +1,249 @@
+#! /usr/bin/env python
+#
+# A Python script to remove old backups.
+#
+# Specify the directories to search. Files written by db-backup.py, which are
+# named DATABASE.YYYY-MM-DD.TYPE followed by any number of extensions, are
+# grouped into one backup for each database and date. The newest KEEP backups
+# of each database in each directory are always kept, and any other backup
+# older than AGE days is removed, along with all of its files. Any other file
+# older than AGE days is removed, as by find -mtime.
+#
+# Run with --dry-run to see what would be removed.
+#
+# Requires Python 2.7 or greater.
+#
+# Author:  Pig Monkey (pm@pig-monkey.com)
+# Website: https://github.com/pigmonkey/backups
+#
+###############################################################################
+import datetime
+import os
+import re
+import stat
+import sys
+import threading
+import time
+import Queue
+import argparse
+from multiprocessing.pool import ThreadPool
+
+# Use scandir where it is available, to save an lstat call for every entry.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Set the directories to search.
+DIRECTORIES = [os.path.expanduser('~/backup')]
+
+# The age given in days. Set to None to remove backups by count alone.
+AGE = 60
+
+# Set the number of backups of each database to keep, no matter how old they
+# are. Set to 0 to remove backups by age alone.
+KEEP = 0
+
+# Set the names of directories that should not be searched. The chunks of a
+# db-backup.py store are shared between backups, so they must only be removed
+# by db-backup.py --collect.
+EXCLUDE = ['chunks']
+
+# Set the number of directories to search at the same time, and the number of
+# files to remove in each batch.
+JOBS = 4
+BATCH_SIZE = 100
+
+# Stop defining variables here.
+###############################################################################
+
+# Match the files written by db-backup.py.
+BACKUP_PATTERN = re.compile(r'^(.+)\.(\d{4}-\d{2}-\d{2})\.[^.].*$')
+
+
+def list_directory(path):
+    """
+    List a directory. Return a list of (path, is_directory, size, mtime)
+    tuples for its entries. Symbolic links are treated as files.
+    """
+    entries = []
+    if scandir:
+        for entry in scandir(path):
+            st = entry.stat(follow_symlinks=False)
+            entries.append((entry.path, entry.is_dir(follow_symlinks=False),
+                            st.st_size, st.st_mtime))
+    else:
+        for name in os.listdir(path):
+            entry = os.path.join(path, name)
+            st = os.lstat(entry)
+            entries.append((entry, stat.S_ISDIR(st.st_mode), st.st_size,
+                            st.st_mtime))
+    return entries
+
+
+def walk(paths, jobs):
+    """
+    List the files below the given paths with a pool of threads. Return a
+    list of (path, size, mtime) tuples.
+    """
+    queue = Queue.Queue()
+    lock = threading.Lock()
+    files = []
+
+    def worker():
+        """List directories from the queue until given None."""
+        while True:
+            path = queue.get()
+            if path is None:
+                return
+            try:
+                found = []
+                for entry, is_directory, size, mtime in list_directory(path):
+                    if not is_directory:
+                        found.append((entry, size, mtime))
+                    elif os.path.basename(entry) not in EXCLUDE:
+                        queue.put(entry)
+                with lock:
+                    files.extend(found)
+            except OSError as error:
+                print 'Could not list %s: %s' % (path, error.strerror)
+            finally:
+                queue.task_done()
+
+    for path in paths:
+        queue.put(path)
+    threads = []
+    for i in range(max(1, jobs)):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    # Once every directory has been listed, stop the workers.
+    queue.join()
+    for thread in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    return files
+
+
+def plan(files, age, keep, now):
+    """
+    Given a list of (path, size, mtime) tuples, return the list of those that
+    should be removed.
+    """
+    backups = {}
+    removals = []
+    for path, size, mtime in files:
+        match = BACKUP_PATTERN.match(os.path.basename(path))
+        if match:
+            group = (os.path.dirname(path), match.group(1))
+            backups.setdefault(group, {}).setdefault(
+                match.group(2), []).append((path, size, mtime))
+        elif age is not None and now - mtime > age * 86400:
+            removals.append((path, size, mtime))
+
+    today = datetime.date.fromtimestamp(now)
+    for dates in backups.values():
+        # The dates sort in the same order as the days they name.
+        for day in sorted(dates, reverse=True)[keep:]:
+            if age is None or (today - datetime.datetime.strptime(
+                    day, '%Y-%m-%d').date()).days > age:
+                removals.extend(dates[day])
+    return sorted(removals)
+
+
+def remove_batch(batch):
+    """
+    Remove a batch of files. Return the number of bytes freed, a list of the
+    files that were removed and a list of those that could not be.
+    """
+    freed = 0
+    removed = []
+    errors = []
+    for path, size, mtime in batch:
+        try:
+            os.remove(path)
+            freed += size
+            removed.append(path)
+        except OSError as error:
+            errors.append('%s: %s' % (path, error.strerror))
+    return freed, removed, errors
+
+
+def remove(removals, batch_size, jobs):
+    """
+    Remove the files in batches from a pool of threads. Return the number of
+    bytes freed, a list of the files that were removed and a list of those
+    that could not be.
+    """
+    batches = [removals[i:i + batch_size]
+               for i in range(0, len(removals), batch_size)]
+    if not batches:
+        return 0, [], []
+    pool = ThreadPool(max(1, min(jobs, len(batches))))
+    try:
+        results = pool.map(remove_batch, batches)
+    finally:
+        pool.close()
+        pool.join()
+    freed = 0
+    removed = []
+    errors = []
+    for batch_freed, batch_removed, batch_errors in results:
+        freed += batch_freed
+        removed.extend(batch_removed)
+        errors.extend(batch_errors)
+    return freed, removed, errors
+
+
+def parse_age(value):
+    """Parse the --age option, where 'none' disables removal by age."""
+    if value.lower() == 'none':
+        return None
+    return int(value)
+
+
+def main():
+    """Remove old backups, or show what would be removed."""
+    # Parse the arguments.
+    parser = argparse.ArgumentParser(description='Remove old backups.')
+    parser.add_argument('directories', nargs='*', metavar='DIRECTORY',
+                        help='directories to search, instead of DIRECTORIES')
+    parser.add_argument('-a', '--age', type=parse_age, default=AGE,
+                        help='remove backups older than this many days, '
+                        'or none')
+    parser.add_argument('-k', '--keep', type=int, default=KEEP,
+                        help='the number of backups of each database to keep')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='show what would be removed without removing it')
+    parser.add_argument('-j', '--jobs', type=int, default=JOBS,
+                        help='the number of directories to search at once')
+    args = parser.parse_args()
+
+    if args.age is None and not args.keep:
+        parser.error('give an age, a number of backups to keep, or both')
+
+    removals = plan(walk(args.directories or DIRECTORIES, args.jobs), args.age,
+                    args.keep, time.time())
+    if args.dry_run:
+        for path, size, mtime in removals:
+            print 'Would remove %s' % (path)
+        print 'Would free %d bytes in %d files.' % (
+            sum([size for path, size, mtime in removals]), len(removals))
+    else:
+        freed, removed, errors = remove(removals, BATCH_SIZE, args.jobs)
+        for path in removed:
+            print 'Removed %s' % (path)
+        for error in errors:
+            print 'Could not remove %s' % (error)
+        print 'Freed %d bytes in %d files.' % (freed, len(removed))
+        if errors:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
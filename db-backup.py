@@ -4,7 +4,7 @@
 #
 # Backups are stored in the given directory. A GPG symmetrically encrypted
 # tar of the backup and a hash of the backup are emailed to the given
-# addresses via SMTP.
+# addresses via SMTP, and sent to any other given destinations.
 #
 # Currently supported databases:
 #       - MySQL
@@ -21,16 +21,23 @@
 ##############################################################################
 
 from datetime import date
+import atexit
+import hashlib
+import json
+import resource
+import shutil
 import subprocess
 import sys
 import os
 import getopt
-from smtplib import SMTP
-from smtplib import SMTP_SSL
-from email.MIMEMultipart import MIMEMultipart
-from email.MIMEBase import MIMEBase
-from email import Encoders
-from email.Utils import COMMASPACE
+import re
+import threading
+import time
+import urlparse
+import zlib
+import ConfigParser
+# The mail modules, uuid and multiprocessing are slow to import, and are only
+# needed by some runs, so they are imported by the functions that use them.
 
 # Initialize database backup variables.
 # These can be set here, but will be overriden by command-line options.
@@ -42,6 +49,14 @@ PASSWORD = None
 DIRECTORY = None
 MAIL = None
 KEY = None
+STREAM = False
+CONFIG = None
+JOIN = None
+BENCHMARK = None
+RESTORE = None
+COLLECT = False
+RESUME = False
+VERIFY = None
 
 # Define where the PostgreSQL Password File should be.
 # This file is used to store login information for databases.
@@ -51,12 +66,55 @@ KEY = None
 POSTGRESQL_FILE = os.path.expanduser('~/.pgpass')
 
 # Set locations of programs.
-# OPENSSL may be set to False if you don't want to generate a hash
+MYSQL = '/usr/bin/mysql'
 MYSQLDUMP = '/usr/bin/mysqldump'
 PG_DUMP = '/usr/bin/pg_dump'
-OPENSSL = '/usr/bin/openssl'
 TAR = '/bin/tar'
 GPG = '/usr/bin/gpg'
+BZIP2 = '/bin/bzip2'
+GZIP = '/bin/gzip'
+PIGZ = '/usr/bin/pigz'
+XZ = '/usr/bin/xz'
+ZSTD = '/usr/bin/zstd'
+LZ4 = '/usr/bin/lz4'
+IONICE = '/usr/bin/ionice'
+SFTP = '/usr/bin/sftp'
+RSYNC = '/usr/bin/rsync'
+AWS = '/usr/bin/aws'
+TARSNAPPER = '/usr/local/bin/tarsnapper.py'
+
+# Set which compressor to use: bzip2, gzip, pigz, xz, zstd or lz4. A level may
+# be given after a colon, such as 'zstd:19' or 'xz:6'. COMPRESSION_THREADS sets
+# the number of threads used by pigz, xz and zstd, where 0 means one for each
+# CPU.
+COMPRESSION = 'bzip2'
+COMPRESSION_THREADS = 0
+
+# Set the format of PostgreSQL dumps: plain, custom or directory. Plain dumps
+# are a single SQL file. Custom dumps are compressed by pg_dump and restored
+# with pg_restore. Directory dumps are written by PG_JOBS connections at once,
+# and are then packaged into a single tar file so that the rest of the backup
+# treats them as one file.
+PG_FORMAT = 'plain'
+PG_JOBS = 1
+
+# Set the options given to every mysqldump. By default each dump reads from a
+# single transaction, rather than locking tables, and streams rows rather than
+# buffering whole tables in memory. The transaction is only consistent for
+# transactional tables, such as InnoDB.
+MYSQLDUMP_OPTIONS = ['--single-transaction', '--quick']
+
+# Set the format of MySQL dumps: single or tables. Single dumps are one SQL
+# file. Tables dumps write the schema to one file and the rows of each table to
+# another, dumping MYSQL_JOBS tables at once, largest first. A manifest lists
+# the files in the order they should be restored, along with their hashes, and
+# the files are then packaged into a single tar file. Each table is read from
+# its own transaction, so tables dumps are consistent within each table but not
+# across tables. As a restore may then break the links between tables, tables
+# dumps are refused unless MYSQL_TABLE_SNAPSHOTS is set to True.
+MYSQL_FORMAT = 'single'
+MYSQL_JOBS = 1
+MYSQL_TABLE_SNAPSHOTS = False
 
 # Define mail server options.
 MAIL_SSL = True
@@ -65,13 +123,109 @@ SMTP_SERVER = 'mail.domain.tld'
 SMTP_USER = 'user'
 SMTP_PASS = 'myawesomepassword'
 
-# Set which hash algorithm to use.
-# For options, see '$ openssl dgst -h'
+# Set the size of the chunks that the attachment is read and sent in. Memory
+# use while emailing depends on this, not on the size of the backup. It should
+# be a multiple of 57, the number of bytes in each line of base64.
+MAIL_CHUNK_SIZE = 57 * 1024
+
+# Mail providers limit the size of messages. If MAIL_SPLIT_SIZE is set, a backup
+# larger than this is split into numbered parts of this size (in bytes, or with
+# a K, M or G suffix), each sent in its own message along with a manifest of
+# the hashes of every part. The parts are sent over MAIL_CONNECTIONS SMTP
+# connections at the same time. Save every part and the manifest to one
+# directory, and run db-backup.py --join MANIFEST to check and rejoin them.
+MAIL_SPLIT_SIZE = None
+MAIL_CONNECTIONS = 2
+
+# Send each backup to other destinations, as well as or instead of email. Each
+# destination is given as a URL, whose scheme decides how it is sent:
+#     /path or file:///path              copied to a local directory
+#     sftp://[user@]host[:port]/path     uploaded with sftp
+#     ssh://[user@]host[:port]/path      copied with rsync over ssh
+#     rsync://host/module/path           copied to an rsync daemon
+#     s3://bucket/prefix                 uploaded in parts with the AWS CLI
+#     tarsnap:[name]                     archived with tarsnapper.py's settings
+# Like email, the destinations receive the encrypted backup, so a key is
+# required. The backup is sent to every destination, and emailed, at the same
+# time. Each destination is tried up to DESTINATION_ATTEMPTS times, waiting
+# DESTINATION_DELAY seconds after the first failure, and twice as long after
+# each failure after that. Set S3_ENDPOINT to the URL of an S3 compatible
+# store, such as MinIO, to use it instead of Amazon S3.
+DESTINATIONS = []
+DESTINATION_ATTEMPTS = 3
+DESTINATION_DELAY = 30
+S3_ENDPOINT = None
+
+# Set which hash algorithm to use. The hash is computed while the dump is
+# being written. HASH may be set to False if you don't want to generate a hash.
+# For options, see hashlib.algorithms_available in Python.
 HASH = 'sha512'
 
+# Set any additional hash algorithms to compute at the same time. Each is
+# written as another line of the checksum file. For example:
+#     EXTRA_HASHES = ['blake2b512']
+EXTRA_HASHES = []
+
 # Get today's date.
 TODAY = date.today()
 
+# Set the size of the chunks read from the dump.
+CHUNK_SIZE = 64 * 1024
+
+# Set the number of databases that may be backed up at the same time when
+# running from a batch configuration file, and the number of those that may be
+# dumped from any one host at the same time. Both may be overridden in the
+# configuration file.
+JOBS = 1
+HOST_JOBS = 1
+
+# Keep plain dumps in a deduplicating store. Each dump is split into chunks at
+# points chosen by their content, so that a chunk which has not changed since
+# an earlier dump is only stored once, even if the data before it has grown or
+# shrunk. The chunks are kept, compressed, in the STORE directory, and the dump
+# in the backup directory is replaced by a list of its chunks ending in
+# .chunks. Rebuild the dump with --restore. Chunks are cut at the end of a
+# line, which suits SQL dumps, and lines longer than four times
+# STORE_CHUNK_SIZE are cut into fixed-size pieces. Streamed dumps are already
+# compressed, so they are not stored. Set STORE to None to disable it.
+STORE = None
+STORE_CHUNK_SIZE = 64 * 1024
+
+# Check backups with --verify DIRECTORY, using VERIFY_JOBS jobs at once. Each
+# backup is decrypted and decompressed as needed, and hashed, without being
+# written anywhere, and compared with its checksum file. Backups that passed
+# are remembered in VERIFY_CACHE by their size and modification time, and are
+# not checked again until they change. Set VERIFY_CACHE to None to always
+# check everything.
+VERIFY_JOBS = 4
+VERIFY_CACHE = os.path.expanduser('~/.cache/db-backup/verified')
+
+# Record how long each stage of each backup takes, how much data goes in and
+# out of it and how much CPU time its child processes use. Each stage is
+# appended to METRICS_FILE as a line of JSON, and a summary of the run is
+# written to PROMETHEUS_FILE for the Prometheus node exporter's textfile
+# collector, replacing the summary of the previous run. Each stage is labelled
+# with its database and host. Set either to None to disable it. CPU time is
+# measured across all child processes, so it is only approximate when stages
+# run at the same time.
+METRICS_FILE = None
+PROMETHEUS_FILE = None
+
+# Limit the rate that dumps are read at, and that mail is sent at, during the
+# given times of day. Each is a comma separated list of periods and rates in
+# bytes per second, such as '08:00-18:00 2M, 18:00-22:00 10M'. A period may
+# cross midnight. Outside of every period, and with a rate of 0, there is no
+# limit. The limit is shared by every database backed up at the same time.
+THROTTLE = None
+MAIL_THROTTLE = None
+
+# Lower the CPU priority (from 1 to 19) and the I/O scheduling class (1 for
+# realtime, 2 for best-effort and 3 for idle) and level (from 0 to 7) of the
+# backup and every program it runs. Set to None to leave them unchanged.
+NICE = None
+IONICE_CLASS = None
+IONICE_LEVEL = None
+
 # Stop defining variables here
 ##############################################################################
 
@@ -88,250 +242,569 @@ def usage():
         -p, --password PASS     # The database password.
         -f, --directory DIR     # The destination directory.
         -m, --mail EMAIL        # The email address to send the backup to. (Optional)
-        -k, --key KEY           # The encryption key. (Required if --mail option is used.)
+        -D, --destination URLS  # Also send the backup to the given destinations.
+                                # (Ex: /mnt/offsite,s3://bucket/path)
+        -k, --key KEY           # The encryption key. (Required if --mail or
+                                # --destination is used.)
+        -s, --stream            # Stream the dump through compression and encryption,
+                                # without writing the uncompressed dump to disk.
+        -c, --config FILE       # Back up every database listed in the given
+                                # configuration file, ignoring the options above.
+        -J, --join MANIFEST     # Check the parts of a backup that was emailed in
+                                # parts, and join them back together.
+        -z, --compression NAME  # The compressor to use, with an optional level.
+                                # (Ex: zstd:19)
+        -b, --benchmark FILE    # Compress the given sample dump with each
+                                # compressor, or only with --compression if given,
+                                # and report how each performed.
+        -F, --pg-format FORMAT  # The PostgreSQL dump format: plain, custom or
+                                # directory.
+        -j, --pg-jobs JOBS      # The number of connections to dump a PostgreSQL
+                                # database with in the directory format.
+        -S, --store DIRECTORY   # Keep plain dumps in a deduplicating store in the
+                                # given directory.
+        -R, --restore CHUNKS    # Rebuild a dump from the store, and check it
+                                # against its checksum file.
+        -r, --resume            # Continue the last backup of the database from
+                                # the last stage it completed.
+        -V, --verify DIRECTORY  # Check every backup in the directory against its
+                                # checksum file. (Requires --key for encrypted
+                                # backups.)
+        -l, --throttle LIMITS   # Limit the rate that dumps are read at during
+                                # the given times. (Ex: '08:00-18:00 2M')
+        -C, --collect           # Remove chunks from the store that no backup in
+                                # the backup directory, or in any directory of the
+                                # configuration file, uses.
+        -M, --mysql-format FORMAT
+                                # The MySQL dump format: single or tables.
+        -T, --mysql-jobs JOBS   # The number of tables to dump at once in the
+                                # tables format.
+        --mysql-table-snapshots # Allow the tables format, which reads each
+                                # table from its own snapshot.
         -h, --help              # Displays this help list.
     '''
 
-# Get any flags from the user
-try:
-    opts, args = getopt.getopt(sys.argv[1:], "t:d:h:u:p:f:m:k:h",
-        ["type=", "database=", "host=", "user=", "password=", "directory=",
-        "mail=", "key=", "help"])
-except getopt.GetoptError:
-    usage()
-    sys.exit(2)
-for opt, arg in opts:
-    if opt in ("-h", "--help"):
-        usage()
-        sys.exit()
-    elif opt in ("-t", "--type"):
-        TYPE = arg.lower()
-    elif opt in ("-d", "--database"):
-        DATABASE = arg
-    elif opt in ("-h", "--host"):
-        HOST = arg
-    elif opt in ("-u", "--user"):
-        USER = arg
-    elif opt in ("-p", "--password"):
-        PASSWORD = arg
-    elif opt in ("-f", "--directory"):
-        DIRECTORY = arg
-    elif opt in ("-m", "--mail"):
-        MAIL = arg.split(',')
-    elif opt in ("-k", "--key"):
-        KEY = arg
 
-# Define the supported database types
-SUPPORTED_DATABASES = ('mysql', 'postgresql',)
+class BackupError(Exception):
+    """Raised when a database backup cannot be completed."""
+    pass
+
+
+def report(message):
+    """Print a progress message, unless running in batch mode."""
+    if not QUIET:
+        print message
 
-# Check to make sure all required options have been given.
-if not DATABASE:
-    print 'No database specified.'
-    usage()
-    sys.exit(2)
-if not TYPE:
-    print 'No database type specified.'
-    usage()
-    sys.exit(2)
-if not DIRECTORY:
-    print 'No backup directory specified.'
-    usage()
-    sys.exit(2)
-if MAIL and not KEY:
-    print 'No encryption key specified.'
-    usage()
-    sys.exit(2)
-
-# Make sure the specified database type is specified.
-if TYPE not in SUPPORTED_DATABASES:
-    print 'Unsupported database type specified. Currently only MySQL and PostgreSQL are supported.'
-    sys.exit(2)
-
-# If a database user was not specified, assume that the name of the database is
-# also the name of the user.
-if not USER:
-    USER = DATABASE
-    print 'No database user specified. Assuming that the name of the database is also the username.'
-
-# If a database hostname was not specified, assume that it is localhost.
-if not HOST:
-    HOST = 'localhost'
-    print 'No hostname specified. Assuming that the host is localhost.'
-
-# Create the backup directory if it doesn't exist
-if not os.path.exists(DIRECTORY):
+
+def start_metric():
+    """Return the time and child resource usage at the start of a stage."""
+    return (time.time(), resource.getrusage(resource.RUSAGE_CHILDREN))
+
+
+def record_metric(stage, database, started, bytes_in=0, bytes_out=0,
+                  error=None, host=None):
+    """
+    Record the wall time, child CPU time and data sizes of a finished stage,
+    given the value returned by start_metric when it started. The host tells
+    apart databases of the same name on different hosts.
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    METRICS.append({
+        'time': started[0],
+        'stage': stage,
+        'database': database,
+        'host': host,
+        'seconds': time.time() - started[0],
+        'cpu_user_seconds': usage.ru_utime - started[1].ru_utime,
+        'cpu_system_seconds': usage.ru_stime - started[1].ru_stime,
+        'bytes_in': bytes_in,
+        'bytes_out': bytes_out,
+        'error': error,
+    })
+
+
+def escape_label(value):
+    """Escape a Prometheus label value."""
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def write_metrics():
+    """
+    Append the recorded metrics to METRICS_FILE as lines of JSON, and write a
+    summary of them to PROMETHEUS_FILE.
+    """
+    if METRICS_FILE and METRICS:
+        f = open(METRICS_FILE, 'a')
+        for metric in METRICS:
+            f.write(json.dumps(metric, sort_keys=True) + '\n')
+        f.close()
+    if not PROMETHEUS_FILE:
+        return
+    lines = []
+    for key, name, description in (
+            ('seconds', 'seconds', 'Wall time spent in each stage.'),
+            (None, 'cpu_seconds', 'CPU time used by each stage.'),
+            ('bytes_in', 'input_bytes', 'Data read by each stage.'),
+            ('bytes_out', 'output_bytes', 'Data written by each stage.'),
+            ('error', 'failed', 'Whether each stage failed.')):
+        name = 'db_backup_stage_' + name
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s gauge' % name)
+        for metric in METRICS:
+            if key is None:
+                value = (metric['cpu_user_seconds'] +
+                         metric['cpu_system_seconds'])
+            elif key == 'error':
+                value = int(bool(metric['error']))
+            else:
+                value = metric[key]
+            lines.append('%s{database="%s",host="%s",stage="%s"} %s' %
+                         (name, escape_label(metric['database']),
+                          escape_label(metric['host'] or ''),
+                          escape_label(metric['stage']), value))
+    lines.append('# HELP db_backup_last_run_timestamp_seconds Time that '
+                 'db-backup last finished.')
+    lines.append('# TYPE db_backup_last_run_timestamp_seconds gauge')
+    lines.append('db_backup_last_run_timestamp_seconds %f' % time.time())
+    # The textfile collector may read the file at any time, so write it
+    # atomically.
+    temporary = PROMETHEUS_FILE + '.tmp'
+    f = open(temporary, 'w')
+    f.write('\n'.join(lines) + '\n')
+    f.close()
+    os.rename(temporary, PROMETHEUS_FILE)
+
+
+def start_process(command, **kwargs):
+    """Start a process, complaining if the binary could not be found."""
     try:
-        print 'Creating directory %s...' % (DIRECTORY)
-        os.makedirs(DIRECTORY)
+        return subprocess.Popen(command, **kwargs)
     except OSError:
-        print 'Could not create directory %s' % (DIRECTORY)
-        sys.exit(1)
+        raise BackupError('Could not find %s' % (command[0]))
 
-# If the type is MySQL, a password is required.
-if not PASSWORD and TYPE == 'mysql':
-    print 'No database password specified.'
-    usage()
-    sys.exit(2)
-
-# Change the directory
-os.chdir(DIRECTORY)
-
-# Test directory permissions
-try:
-    test = open('.test', 'wb')
-except IOError:
-    print 'Cannot write to %s' % (DIRECTORY)
-    sys.exit(1)
-else:
-    test.close()
-    os.remove('.test')
-    
-# Perform the backups
-filename = DATABASE + '.' + str(TODAY)
-
-backup_file = filename + '.' + TYPE
-checksum_file = backup_file + '.' + HASH
-tar_file = filename + '.tar.bz'
-crypt_file = tar_file + '.gpg'
-
-# Backup the MySQL database.
-if TYPE == 'mysql':
-    backup = open(backup_file, 'wb')
 
+def execute(command):
+    """Run a command, complaining if it could not be run successfully."""
     try:
-        p = subprocess.check_call([MYSQLDUMP, '-u', USER, '-p' + PASSWORD,
-                                  '-h', HOST, DATABASE], stdout=backup)
+        subprocess.check_call(command)
     except OSError:
-        os.remove(backup_file)
-        print 'Could not find %s' % (MYSQLDUMP)
+        raise BackupError('Could not find %s' % (command[0]))
     except subprocess.CalledProcessError:
-        os.remove(backup_file)
-        print '%s returned non-zero status' % (MYSQLDUMP)
-    else:
-        backup.close()
+        raise BackupError('%s returned non-zero status' % (command[0]))
 
-# Backup the PostgreSQL database.
-if TYPE == 'postgresql':
-    # Check for the current database in the PostgreSQL Password File.
+
+def execute_into(command, path):
+    """
+    Run a command, writing its standard output into the file at the given
+    path and hashing it as it is written. Return the SHA-256 hex digest of the
+    file.
+    """
+    digest = hashlib.sha256()
+    output = open(path, 'wb')
     try:
-        # If the file exists, open it.
-        f = open(POSTGRESQL_FILE, 'r')
-    except:
-        # If the file does not exist, make sure we were passed a password.
+        process = start_process(command, stdout=subprocess.PIPE)
+    except BackupError:
+        output.close()
+        os.remove(path)
+        raise
+    try:
+        copy_stream(process.stdout, output, [digest])
+    except IOError as error:
+        process.stdout.close()
+        process.wait()
+        output.close()
+        os.remove(path)
+        raise BackupError('Could not write %s: %s' % (path, error))
+    process.stdout.close()
+    output.close()
+    if process.wait() != 0:
+        os.remove(path)
+        raise BackupError('%s returned non-zero status' % (command[0]))
+    return digest.hexdigest()
+
+
+def new_digests():
+    """Return a list of new hash objects for HASH and any EXTRA_HASHES."""
+    if not HASH:
+        return []
+    return [hashlib.new(name) for name in [HASH] + EXTRA_HASHES]
+
+
+def current_rate(throttle, now=None):
+    """
+    Given a throttle such as '08:00-18:00 2M', return the rate in bytes per
+    second that applies at the given time, or 0 if there is no limit.
+    """
+    if not throttle:
+        return 0
+    now = now or time.localtime()
+    minute = now.tm_hour * 60 + now.tm_min
+    for period in throttle.split(','):
+        hours, rate = period.split()
+        start, end = [int(clock[:2]) * 60 + int(clock[3:])
+                      for clock in hours.split('-')]
+        if start <= end:
+            active = start <= minute < end
+        else:
+            active = minute >= start or minute < end
+        if active:
+            return parse_size(rate)
+    return 0
+
+
+class TokenBucket(object):
+    """
+    Limit the rate that data passes through, across every thread that uses
+    the bucket. The bucket holds up to a second of data.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tokens = 0
+        self.updated = time.time()
+
+    def consume(self, size, throttle):
+        """Wait until the given number of bytes may pass the throttle."""
+        rate = current_rate(throttle)
+        if not rate:
+            return
+        self.lock.acquire()
         try:
-            pgpass = '*:*:' + DATABASE + ':' + USER + ':' + PASSWORD + '\n'
-        except TypeError:
-            print 'No database password specified.'
-            sys.exit(2)
-        # Create the file and add the current database.
-        f = open(POSTGRESQL_FILE, 'w')
-        f.write(pgpass)
-        f.close()
-        # Permissions must be 0600.
-        os.chmod(POSTGRESQL_FILE, 0600)
-    else:
-        # Check if the current database is in the file.
-        match = False
-        for line in f:
-            search = line.find(':' + DATABASE + ':')
-            if search != -1:
-                match = True
-                break
-        # If the database is not in the file, add it.
-        if match is False:
-            # Close the file so that we can reopen it for appending.
-            f.close()
-            # Make sure we were passed the password.
-            try:
-                pgpass = '*:*:' + DATABASE + ':' + USER + ':' + PASSWORD + '\n'
-            except TypeError:
-                print 'No database password specified.'
-                sys.exit(2)
-            f = open(POSTGRESQL_FILE, 'a')
-            f.write(pgpass)
-            f.close()
+            now = time.time()
+            self.tokens = min(rate, self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            # Take the tokens now, even if it leaves the bucket in debt, so
+            # that threads which come after wait their turn.
+            self.tokens -= size
+            wait = -self.tokens / float(rate)
+        finally:
+            self.lock.release()
+        if wait > 0:
+            time.sleep(wait)
 
-    try:
-        p = subprocess.check_call([PG_DUMP, '-h', HOST, '-U', USER, DATABASE,
-                                  '-f', backup_file])
-    except OSError:
-        print 'Could not find %s' % (PG_DUMP)
-    except subprocess.CalledProcessError:
-        print '%s returned non-zero status' % (PG_DUMP)
-
-# Make sure backup file was created.
-try:
-    f = open(backup_file, 'rb')
-except IOError:
-    print 'Backup failed!'
-    sys.exit(1)
-else:
+
+def lower_priority():
+    """
+    Lower the CPU and I/O priority of this process, which every program it
+    runs inherits.
+    """
+    if NICE:
+        os.nice(NICE)
+    if IONICE_CLASS:
+        command = [IONICE, '-c', str(IONICE_CLASS)]
+        if IONICE_LEVEL is not None:
+            command.extend(['-n', str(IONICE_LEVEL)])
+        execute(command + ['-p', str(os.getpid())])
+
+
+def copy_stream(source, destination, digests, bucket=None):
+    """
+    Copy the source file object into the destination file object in chunks,
+    updating each of the digests along the way. If the destination is None,
+    the source is only hashed. If a bucket is given, the copy is limited to
+    THROTTLE. Return the number of bytes copied.
+    """
+    size = 0
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        if bucket:
+            bucket.consume(len(chunk), THROTTLE)
+        for digest in digests:
+            digest.update(chunk)
+        if destination:
+            destination.write(chunk)
+        size += len(chunk)
+    return size
+
+
+def write_checksums(checksum_file, backup_file, checksums):
+    """
+    Write the (algorithm, hex digest) checksums of the backup file to the
+    checksum file, one per line, in the same format as openssl dgst. Return
+    the SHA-256 hex digest of the checksum file.
+    """
+    contents = ''.join(['%s(%s)= %s\n' % (name.upper(), backup_file,
+                                           hexdigest)
+                        for name, hexdigest in checksums])
+    f = open(checksum_file, 'w')
+    f.write(contents)
     f.close()
+    return hashlib.sha256(contents).hexdigest()
 
-# Check if backup file is empty.
-if os.stat(backup_file).st_size == 0:
-    print 'Backup failed!'
-    os.remove(backup_file)
-    sys.exit(1)
 
-# Generate the hash, if requested.
-if OPENSSL:
+def file_digest(path, algorithm='sha256'):
+    """Return the hex digest of a file."""
+    digest = hashlib.new(algorithm)
+    f = open(path, 'rb')
     try:
-        p = subprocess.check_call([OPENSSL, 'dgst', '-' + HASH, '-out',
-            checksum_file, backup_file])
-    except OSError:
-        os.remove(backup_file)
-        print '\tCould not find %s' % (OPENSSL)
-    except subprocess.CalledProcessError:
-        print '\t%s returned non-zero status' % (OPENSSL)
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
 
-    # Make sure hash file was created.
+def load_journal(path):
+    """Return the contents of a journal, or an empty dictionary."""
     try:
-        f = open(checksum_file, 'rb')
+        f = open(path, 'r')
     except IOError:
-        print '\tBackup failed!'
-    else:
+        return {}
+    try:
+        return json.load(f)
+    except ValueError:
+        return {}
+    finally:
         f.close()
 
-print 'Backup successful!'
 
-if MAIL:
-    print 'Emailing...'
-    # Compress the backup and hash file
+def save_journal(path, journal):
+    """Save a journal, so that it is never seen half written."""
+    temporary = path + '.tmp'
+    f = open(temporary, 'w')
+    json.dump(journal, f)
+    f.close()
+    os.rename(temporary, path)
+
+
+def stage_complete(journal, stage, directory):
+    """
+    Return whether the journal records the stage as complete, and every file
+    that the stage wrote is still on disk and matches its recorded hash.
+    """
+    if stage not in journal.get('stages', {}):
+        return False
+    for name, (algorithm, hexdigest) in journal['stages'][stage][
+            'files'].items():
+        path = os.path.join(directory, name)
+        if not os.path.exists(path) or file_digest(path,
+                                                   algorithm) != hexdigest:
+            return False
+    return True
+
+
+def dump_backup(command, destination, database, stage='dump', host=None,
+                extra_digests=()):
+    """
+    Write the output of a dump command into the destination file, hashing it
+    as it is written. Any extra digests are updated along with the others.
+    Return the list of digests, without the extra ones.
+    """
+    started = start_metric()
+    digests = new_digests()
+    output = open(destination, 'wb')
     try:
-        p = subprocess.check_call([TAR, 'cjf', tar_file, backup_file,
-            checksum_file])
-    except OSError:
-        print '\tCould not find %s' % (TAR)
-    except subprocess.CalledProcessError:
-        print '\t%s returned non-zero status' % (TAR)
+        dump = start_process(command, stdout=subprocess.PIPE)
+    except BackupError:
+        output.close()
+        os.remove(destination)
+        raise
+    size = copy_stream(dump.stdout, output, digests + list(extra_digests),
+                       DUMP_BUCKET)
+    output.close()
+    if dump.wait() != 0:
+        os.remove(destination)
+        raise BackupError('%s returned non-zero status' % (command[0]))
+    record_metric(stage, database, started, bytes_out=size, host=host)
+    return digests
+
+
+# Define the file extension of each compressor.
+COMPRESSORS = {
+    'bzip2': '.bz2',
+    'gzip': '.gz',
+    'pigz': '.gz',
+    'xz': '.xz',
+    'zstd': '.zst',
+    'lz4': '.lz4',
+}
+
+# The lowest and highest level that each compressor accepts. zstd levels above
+# 19 need --ultra, which is added for them.
+COMPRESSION_LEVELS = {
+    'bzip2': (1, 9),
+    'gzip': (1, 9),
+    'pigz': (0, 9),
+    'xz': (0, 9),
+    'zstd': (1, 22),
+    'lz4': (1, 12),
+}
+
 
-    # Encrypt the compressed file
+def compressor_command(compression):
+    """
+    Given a compression setting such as 'zstd:19', return the command that
+    compresses standard input to standard output.
+    """
+    name, _, level = compression.partition(':')
+    if name not in COMPRESSORS:
+        raise BackupError('Unsupported compressor %s' % (name))
+    if name == 'bzip2':
+        command = [BZIP2, '-c']
+    elif name == 'gzip':
+        command = [GZIP, '-c']
+    elif name == 'pigz':
+        command = [PIGZ, '-c']
+        if COMPRESSION_THREADS:
+            command.extend(['-p', str(COMPRESSION_THREADS)])
+    elif name == 'xz':
+        command = [XZ, '-c', '-T%d' % (COMPRESSION_THREADS)]
+    elif name == 'zstd':
+        command = [ZSTD, '-c', '-q', '-T%d' % (COMPRESSION_THREADS)]
+    elif name == 'lz4':
+        command = [LZ4, '-c', '-q']
+    if level:
+        lowest, highest = COMPRESSION_LEVELS[name]
+        if not level.isdigit() or not lowest <= int(level) <= highest:
+            raise BackupError('Unsupported %s level %s, use %d to %d' %
+                              (name, level, lowest, highest))
+        if name == 'zstd' and int(level) > 19:
+            command.append('--ultra')
+        command.append('-%d' % (int(level)))
+    return command
+
+
+def benchmark_compression(sample, compressions):
+    """
+    Compress the sample file with each of the given compression settings, and
+    print the compression ratio, throughput and CPU time of each.
+    """
+    size = os.path.getsize(sample)
+    print '%-12s %8s %10s %10s %10s' % ('Compressor', 'Ratio', 'MB/s',
+                                        'Seconds', 'CPU')
+    for compression in compressions:
+        started = start_metric()
+        try:
+            process = start_process(compressor_command(compression),
+                                    stdin=open(sample, 'rb'),
+                                    stdout=subprocess.PIPE)
+        except BackupError as error:
+            print '%-12s %s' % (compression, error)
+            continue
+        compressed = 0
+        while True:
+            chunk = process.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            compressed += len(chunk)
+        if process.wait() != 0:
+            print '%-12s returned non-zero status' % (compression)
+            continue
+        seconds = time.time() - started[0]
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = (usage.ru_utime - started[1].ru_utime +
+               usage.ru_stime - started[1].ru_stime)
+        print '%-12s %8.2f %10.1f %10.2f %10.2f' % (
+            compression, float(size) / max(compressed, 1),
+            size / 1048576.0 / max(seconds, 0.001), seconds, cpu)
+
+
+def stream_backup(command, destination, database, key=None,
+                  compression=None, host=None):
+    """
+    Stream the output of a dump command through the compressor and, if a key is
+    given, GPG into the destination file. The uncompressed dump is hashed as it
+    passes through, and the file as it is written. Return the list of digests
+    of the dump, and the SHA-256 hex digest of the file.
+    """
+    started = start_metric()
+    digests = new_digests()
+    stages = [compressor_command(compression or COMPRESSION)]
+    if key:
+        stages.append([GPG, '--batch', '-ca', '--passphrase', key])
+
+    # Start the pipeline from its end, so that each stage can write into the
+    # stage after it.
+    output = open(destination, 'wb')
+    processes = []
+    stdout = subprocess.PIPE
     try:
-        p = subprocess.check_call([GPG, '--batch', '-cao', crypt_file,
-                                  '--passphrase', KEY, tar_file])
-    except OSError:
-        print '\tCould not find %s' % (GPG)
-        print '\tEmail failed'
-    except subprocess.CalledProcessError:
-        print '\t%s returned non-zero status' % (GPG)
-
-    # Create the email message
-    msg = MIMEMultipart()
-    msg['From'] = FROM
-    msg['To'] = ', '.join(MAIL)
-    msg['Subject'] = DATABASE + ' Database Backup: ' + str(TODAY)
-
-    # Attach the file
-    part = MIMEBase('application', "pgp-encrypted")
-    part.set_payload( open(crypt_file, 'rb').read() )
-    Encoders.encode_base64(part)
-    part.add_header('Content-Disposition', 'attachment; filename="%s"'
-        %crypt_file
-    )
-    msg.attach(part)
-
-    # Send the mail
+        for stage in reversed(stages):
+            process = start_process(stage, stdin=subprocess.PIPE,
+                                    stdout=stdout)
+            if stdout is not subprocess.PIPE:
+                # The parent must not hold the write end of the pipe open, or
+                # the next stage would never see the end of its input.
+                stdout.close()
+            processes.insert(0, process)
+            stdout = process.stdin
+        dump = start_process(command, stdout=subprocess.PIPE)
+    except BackupError:
+        output.close()
+        if processes:
+            processes[-1].stdout.close()
+        for process in processes:
+            process.stdin.close()
+            process.wait()
+        os.remove(destination)
+        raise
+
+    # Write the output of the last stage into the file from another thread,
+    # hashing it as it is written, while the dump is fed into the first stage.
+    errors = []
+    output_digest = hashlib.sha256()
+    last = processes[-1].stdout
+
+    def drain():
+        """Copy the output of the last stage into the file."""
+        try:
+            copy_stream(last, output, [output_digest])
+        except IOError as error:
+            errors.append('Could not write %s: %s' % (destination, error))
+            # Keep reading, so that the pipeline is not left blocked.
+            copy_stream(last, None, [])
+
+    writer = threading.Thread(target=drain)
+    writer.start()
+
+    # Feed the dump into the first stage, hashing it along the way.
+    pipe = processes[0].stdin
+    size = 0
+    try:
+        size = copy_stream(dump.stdout, pipe, digests, DUMP_BUCKET)
+    except IOError:
+        errors.append('%s stopped accepting input' % (stages[0][0]))
+    try:
+        pipe.close()
+    except IOError:
+        pass
+    dump.stdout.close()
+    writer.join()
+    last.close()
+    output.close()
+
+    binaries = [command[0]] + [stage[0] for stage in stages]
+    for binary, process in zip(binaries, [dump] + processes):
+        if process.wait() != 0:
+            errors.append('%s returned non-zero status' % (binary))
+    if errors:
+        os.remove(destination)
+        raise BackupError(', '.join(errors))
+    record_metric('stream', database, started, bytes_in=size,
+                  bytes_out=os.path.getsize(destination), host=host)
+    return digests, output_digest.hexdigest()
+
+
+def parse_size(size):
+    """
+    Given a size such as '20M', return the number of bytes it represents.
+    Accepts a plain number of bytes, or a number followed by K, M or G.
+    """
+    size = str(size).strip().upper()
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if size[-1:] in multipliers:
+        return int(size[:-1]) * multipliers[size[-1]]
+    return int(size)
+
+
+def connect_smtp():
+    """Return a logged in connection to the SMTP server."""
+    from smtplib import SMTP, SMTP_SSL, SMTPException
     if MAIL_SSL:
         s = SMTP_SSL()
     else:
@@ -339,16 +812,1654 @@ if MAIL:
     try:
         s.connect(SMTP_SERVER)
     except:
-        print '\tCould not connect to specified SMTP server.'
-        os.remove(crypt_file)
-        os.remove(tar_file)
+        raise BackupError('Could not connect to specified SMTP server.')
+    try:
+        s.login(SMTP_USER, SMTP_PASS)
+    except SMTPException as error:
+        s.close()
+        raise BackupError('Could not log in to SMTP server: %s' % (error))
+    return s
+
+
+def send_message(s, subject, addresses, attachments):
+    """
+    Send a message over an SMTP connection. Each attachment is a tuple of the
+    file name and content type to give it, and the path, offset and length of
+    the data to read for it. Each attachment is base64 encoded and written to
+    the connection a chunk at a time, so the message is never held in memory.
+    Return the number of bytes sent.
+    """
+    import base64
+    import uuid
+    from smtplib import SMTPException
+    boundary = '===============%s==' % (uuid.uuid4().hex)
+    code, response = s.mail(FROM)
+    if code != 250:
+        raise SMTPException('Sender refused: %s' % (response))
+    for address in addresses:
+        code, response = s.rcpt(address)
+        if code not in (250, 251):
+            raise SMTPException('Recipient %s refused: %s' % (address,
+                                                              response))
+    code, response = s.docmd('DATA')
+    if code != 354:
+        raise SMTPException('Data refused: %s' % (response))
+
+    # Send the email message headers.
+    data = '\r\n'.join([
+        'From: %s' % (FROM),
+        'To: %s' % (', '.join(addresses)),
+        'Subject: %s' % (subject),
+        'MIME-Version: 1.0',
+        'Content-Type: multipart/mixed; boundary="%s"' % (boundary),
+        '',
+    ])
+    s.send(data)
+    size = len(data)
+
+    for filename, content_type, path, offset, length in attachments:
+        # Send the headers of the attachment.
+        data = '\r\n'.join([
+            '',
+            '--%s' % (boundary),
+            'Content-Type: %s' % (content_type),
+            'MIME-Version: 1.0',
+            'Content-Transfer-Encoding: base64',
+            'Content-Disposition: attachment; filename="%s"' % (filename),
+            '',
+            '',
+        ])
+        s.send(data)
+        size += len(data)
+        # Base64 output never begins a line with a dot, so it does not need
+        # to be escaped for the DATA command.
+        f = open(path, 'rb')
+        try:
+            f.seek(offset)
+            while length > 0:
+                chunk = f.read(min(MAIL_CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                length -= len(chunk)
+                chunk = base64.encodestring(chunk).replace('\n', '\r\n')
+                MAIL_BUCKET.consume(len(chunk), MAIL_THROTTLE)
+                s.send(chunk)
+                size += len(chunk)
+        finally:
+            f.close()
+
+    data = '\r\n--%s--\r\n.\r\n' % (boundary)
+    s.send(data)
+    size += len(data)
+    code, response = s.getreply()
+    if code != 250:
+        raise SMTPException('Message refused: %s' % (response))
+    return size
+
+
+def write_manifest(attachment, part_size):
+    """
+    Write a manifest of the hashes of each part of the attachment, followed by
+    the hash of the whole attachment, in the same format as the checksum file.
+    Return the path of the manifest and a list of (name, offset, length)
+    tuples for the parts.
+    """
+    algorithm = HASH or 'sha512'
+    name = os.path.basename(attachment)
+    total = os.path.getsize(attachment)
+    count = (total + part_size - 1) // part_size
+    whole = hashlib.new(algorithm)
+    parts = []
+    digests = []
+    f = open(attachment, 'rb')
+    try:
+        for number in range(1, count + 1):
+            part_name = '%s.part%03d-of-%03d' % (name, number, count)
+            parts.append((part_name, f.tell(), min(part_size,
+                                                    total - f.tell())))
+            digest = hashlib.new(algorithm)
+            remaining = part_size
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                digest.update(chunk)
+                whole.update(chunk)
+            digests.append((part_name, digest))
+    finally:
+        f.close()
+    digests.append((name, whole))
+
+    manifest = attachment + '.manifest'
+    f = open(manifest, 'w')
+    for part_name, digest in digests:
+        f.write('%s(%s)= %s\n' % (digest.name.upper(), part_name,
+                                   digest.hexdigest()))
+    f.close()
+    return manifest, parts
+
+
+def send_mail(attachment, database, addresses, host=None):
+    """
+    Email the given file to the given addresses, splitting it into parts if it
+    is larger than MAIL_SPLIT_SIZE. The manifest of the parts is written next
+    to the file.
+    """
+    from multiprocessing.pool import ThreadPool
+    from smtplib import SMTPException
+    started = start_metric()
+    subject = '%s Database Backup: %s' % (database, TODAY)
+    total = os.path.getsize(attachment)
+    if MAIL_SPLIT_SIZE and total > parse_size(MAIL_SPLIT_SIZE):
+        manifest, parts = write_manifest(attachment,
+                                         parse_size(MAIL_SPLIT_SIZE))
+        manifest_size = os.path.getsize(manifest)
+        messages = []
+        for number, (part_name, offset, length) in enumerate(parts):
+            messages.append((
+                '%s (part %d of %d)' % (subject, number + 1, len(parts)),
+                [(part_name, 'application/pgp-encrypted', attachment, offset,
+                  length),
+                 (os.path.basename(manifest), 'text/plain', manifest, 0,
+                  manifest_size)]))
+    else:
+        messages = [(subject, [(os.path.basename(attachment),
+                                'application/pgp-encrypted', attachment, 0,
+                                total)])]
+
+    # Share the messages out between the connections, each of which sends
+    # its messages one after another.
+    connections = max(1, min(MAIL_CONNECTIONS, len(messages)))
+    groups = [messages[i::connections] for i in range(connections)]
+
+    def send_group(group):
+        """Send a group of messages over a single connection."""
+        s = connect_smtp()
+        size = 0
+        try:
+            for subject, attachments in group:
+                size += send_message(s, subject, addresses, attachments)
+            s.quit()
+        except (SMTPException, EnvironmentError) as error:
+            s.close()
+            raise BackupError('Could not send mail: %s' % (error))
+        return size
+
+    if connections == 1:
+        sizes = [send_group(groups[0])]
+    else:
+        pool = ThreadPool(connections)
+        try:
+            sizes = pool.map(send_group, groups)
+        finally:
+            pool.close()
+            pool.join()
+    record_metric('mail', database, started, bytes_in=total,
+                  bytes_out=sum(sizes), host=host)
+    report('\tMessage sent!')
+
+
+def join_parts(manifest):
+    """
+    Check the hash of every part listed in a manifest, and only if all of them
+    are intact, join them back into the original file and check its hash. The
+    parts must be in the same directory as the manifest. Return the path of the
+    joined file.
+    """
+    directory = os.path.dirname(manifest)
+    entries = []
+    for line in open(manifest, 'r'):
+        match = re.match(r'^([\w-]+)\((.+)\)= ([0-9a-f]+)$', line.strip())
+        if match:
+            entries.append(match.groups())
+    if len(entries) < 2:
+        raise BackupError('%s is not a manifest of parts' % (manifest))
+
+    # Check every part before writing anything.
+    errors = []
+    for algorithm, name, expected in entries[:-1]:
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            errors.append('%s is missing' % (name))
+            continue
+        digest = hashlib.new(algorithm.lower())
+        f = open(path, 'rb')
+        try:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+        finally:
+            f.close()
+        if digest.hexdigest() != expected:
+            errors.append('%s does not match its hash' % (name))
+    if errors:
+        raise BackupError('\n'.join(errors))
+
+    # Join the parts, checking the hash of the whole file as it is written.
+    algorithm, name, expected = entries[-1]
+    path = os.path.join(directory, name)
+    digest = hashlib.new(algorithm.lower())
+    output = open(path, 'wb')
+    try:
+        for part_algorithm, part_name, part_expected in entries[:-1]:
+            f = open(os.path.join(directory, part_name), 'rb')
+            try:
+                copy_stream(f, output, [digest])
+            finally:
+                f.close()
+    finally:
+        output.close()
+    if digest.hexdigest() != expected:
+        os.remove(path)
+        raise BackupError('%s does not match its hash' % (name))
+    return path
+
+
+def send_local(path, destination, database, host=None):
+    """
+    Copy a file into a local directory, through a temporary file so that an
+    interrupted copy is never mistaken for a backup.
+    """
+    directory = urlparse.urlsplit(destination).path
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    target = os.path.join(directory, os.path.basename(path))
+    temporary = target + '.tmp'
+    source = open(path, 'rb')
+    try:
+        f = open(temporary, 'wb')
+        try:
+            copy_stream(source, f, [])
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+    finally:
+        source.close()
+    os.rename(temporary, target)
+
+
+def send_sftp(path, destination, database, host=None):
+    """
+    Upload a file with sftp, under a temporary name which is renamed once the
+    upload is complete.
+    """
+    url = urlparse.urlsplit(destination)
+    command = [SFTP, '-b', '-']
+    if url.port:
+        command.extend(['-P', str(url.port)])
+    command.append(url.netloc.rpartition(':')[0] if url.port else url.netloc)
+    target = '%s/%s' % (url.path.rstrip('/') or '.', os.path.basename(path))
+    # A leading - lets sftp carry on if the command fails, as it will when
+    # there is no earlier upload to remove.
+    batch = 'put "%s" "%s.tmp"\n-rm "%s"\nrename "%s.tmp" "%s"\n' % (
+        path, target, target, target, target)
+    process = start_process(command, stdin=subprocess.PIPE)
+    process.communicate(batch)
+    if process.returncode:
+        raise BackupError('%s returned non-zero status' % (SFTP))
+
+
+def send_rsync(path, destination, database, host=None):
+    """
+    Copy a file with rsync, over ssh or to an rsync daemon. Partly copied files
+    are kept, so that a retry only sends what is missing.
+    """
+    url = urlparse.urlsplit(destination)
+    command = [RSYNC, '--partial']
+    if url.scheme == 'ssh':
+        host = url.netloc
+        if url.port:
+            host = url.netloc.rpartition(':')[0]
+            command.extend(['-e', 'ssh -p %d' % (url.port)])
+        target = '%s:%s/' % (host, url.path.rstrip('/') or '.')
+    else:
+        target = destination.rstrip('/') + '/'
+    execute(command + [path, target])
+
+
+def send_s3(path, destination, database, host=None):
+    """
+    Upload a file to an S3 bucket with the AWS CLI, which sends large files
+    in parts, several at once, and retries each part that fails.
+    """
+    url = urlparse.urlsplit(destination)
+    target = 's3://%s/%s' % (url.netloc, '/'.join(
+        [part for part in (url.path.strip('/'), os.path.basename(path))
+         if part]))
+    command = [AWS, 's3', 'cp', '--only-show-errors', path, target]
+    if S3_ENDPOINT:
+        command.extend(['--endpoint-url', S3_ENDPOINT])
+    execute(command)
+
+
+def load_tarsnapper():
+    """
+    Load tarsnapper.py, and read its configuration file, the first time it is
+    needed. Return the module.
+    """
+    global TARSNAPPER_MODULE
+    import imp
+    TARSNAPPER_LOCK.acquire()
+    try:
+        if TARSNAPPER_MODULE is None:
+            try:
+                module = imp.load_source('tarsnapper', TARSNAPPER)
+            except IOError:
+                raise BackupError('Could not find %s' % (TARSNAPPER))
+            module.read_config(module.CONFIG)
+            TARSNAPPER_MODULE = module
+        return TARSNAPPER_MODULE
+    finally:
+        TARSNAPPER_LOCK.release()
+
+
+def send_tarsnap(path, destination, database, host=None):
+    """
+    Create a Tarsnap archive of a file with tarsnapper.py, named after the
+    database unless a name is given, and add it to tarsnapper's index. The
+    metrics that tarsnapper records are moved into METRICS.
+    """
+    tarsnapper = load_tarsnapper()
+    name = urlparse.urlsplit(destination).path or database
+    if tarsnapper.SUFFIX:
+        name = '%s.%s' % (name, tarsnapper.SUFFIX)
+    try:
+        tarsnapper.create_archive(name, ['-C', os.path.dirname(path) or '.',
+                                         os.path.basename(path)],
+                                  exit_on_error=False, label=name)
+    except tarsnapper.ExecuteError as error:
+        raise BackupError(str(error))
+    finally:
+        # Backups may be sent from several threads at once, so only take the
+        # metrics of this archive.
+        TARSNAPPER_LOCK.acquire()
+        try:
+            metrics = [metric for metric in tarsnapper.METRICS
+                       if metric['label'] == name]
+            for metric in metrics:
+                tarsnapper.METRICS.remove(metric)
+        finally:
+            TARSNAPPER_LOCK.release()
+        for metric in metrics:
+            METRICS.append({
+                'time': metric['time'],
+                'stage': 'tarsnap %s' % (metric['stage']),
+                'database': database,
+                'host': host,
+                'seconds': metric['seconds'],
+                'cpu_user_seconds': metric['cpu_user_seconds'],
+                'cpu_system_seconds': metric['cpu_system_seconds'],
+                'bytes_in': 0,
+                'bytes_out': metric['bytes_out'],
+                'error': metric['error'],
+            })
+    # Each update rewrites the whole index.
+    TARSNAPPER_LOCK.acquire()
+    try:
+        tarsnapper.update_index(created=[name])
+    finally:
+        TARSNAPPER_LOCK.release()
+
+
+# Define the function that sends a backup to each scheme of destination.
+DESTINATION_SCHEMES = {
+    '': send_local,
+    'file': send_local,
+    'sftp': send_sftp,
+    'ssh': send_rsync,
+    'rsync': send_rsync,
+    's3': send_s3,
+    'tarsnap': send_tarsnap,
+}
+
+
+def check_destinations(destinations):
+    """Raise a BackupError if any of the destinations are not supported."""
+    for destination in destinations:
+        if urlparse.urlsplit(destination).scheme not in DESTINATION_SCHEMES:
+            raise BackupError('Unsupported destination %s' % (destination))
+
+
+def send_destination(path, database, destination, host=None):
+    """
+    Send a file to a destination, trying up to DESTINATION_ATTEMPTS times and
+    waiting longer after each failure.
+    """
+    send = DESTINATION_SCHEMES[urlparse.urlsplit(destination).scheme]
+    started = start_metric()
+    delay = DESTINATION_DELAY
+    attempt = 1
+    while True:
+        try:
+            send(path, destination, database, host)
+        except (BackupError, EnvironmentError) as error:
+            if attempt >= DESTINATION_ATTEMPTS:
+                error = 'Could not send to %s: %s' % (destination, error)
+                record_metric('send %s' % (destination), database, started,
+                              error=error, host=host)
+                raise BackupError(error)
+            report('\tCould not send to %s, trying again in %d seconds: %s' %
+                   (destination, delay, error))
+            time.sleep(delay)
+            delay *= 2
+            attempt += 1
+        else:
+            break
+    size = os.path.getsize(path)
+    record_metric('send %s' % (destination), database, started,
+                  bytes_in=size, bytes_out=size, host=host)
+    report('\tSent to %s!' % (destination))
+
+
+def deliver(path, database, addresses=None, destinations=(), sent=(),
+            host=None):
+    """
+    Email a file to the addresses, and send it to each of the destinations,
+    all at the same time. Skip any target listed in sent, where the email is
+    listed as 'mailto:'. Return a list of the targets that the file has been
+    sent to, including those skipped, and a list of the errors of those that
+    failed.
+    """
+    from multiprocessing.pool import ThreadPool
+    targets = [destination for destination in destinations
+               if destination not in sent]
+    if addresses and 'mailto:' not in sent:
+        report('Emailing...')
+        targets.insert(0, 'mailto:')
+
+    def send(target):
+        """Send to a single target, returning any error."""
+        try:
+            if target == 'mailto:':
+                send_mail(path, database, addresses, host)
+            else:
+                send_destination(path, database, target, host)
+        except (BackupError, EnvironmentError) as error:
+            return str(error)
+        return None
+
+    if len(targets) == 1:
+        errors = [send(targets[0])]
+    elif targets:
+        pool = ThreadPool(len(targets))
+        try:
+            errors = pool.map(send, targets)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        errors = []
+    sent = list(sent) + [target for target, error in zip(targets, errors)
+                         if not error]
+    return sent, [error for error in errors if error]
+
+
+def split_chunks(source):
+    """
+    Split a file object into chunks, and yield each one. A chunk ends after a
+    line whose CRC falls below a threshold proportional to the length of the
+    line, so that chunks average STORE_CHUNK_SIZE bytes.
+    """
+    minimum = STORE_CHUNK_SIZE // 4
+    maximum = STORE_CHUNK_SIZE * 4
+    threshold = (1 << 32) // STORE_CHUNK_SIZE
+    pieces = []
+    size = 0
+    while True:
+        line = source.readline(maximum - size)
+        if not line:
+            break
+        pieces.append(line)
+        size += len(line)
+        if size >= maximum or (size >= minimum and
+                               zlib.crc32(line) & 0xffffffff <
+                               len(line) * threshold):
+            yield ''.join(pieces)
+            pieces = []
+            size = 0
+    if pieces:
+        yield ''.join(pieces)
+
+
+def chunk_path(store, name):
+    """Return the path of a chunk in the store."""
+    return os.path.join(store, 'chunks', name[:2], name)
+
+
+def store_backup(backup_path, store, database, host=None):
+    """
+    Move a dump into the store, replacing it with a list of its chunks. Return
+    the path of the list.
+    """
+    import uuid
+    started = start_metric()
+    recipe_path = backup_path + '.chunks'
+    temporary = '%s.%s.tmp' % (recipe_path, uuid.uuid4().hex)
+    recipe = open(temporary, 'w')
+    size = 0
+    written = 0
+    f = open(backup_path, 'rb')
+    try:
+        for chunk in split_chunks(f):
+            name = hashlib.sha256(chunk).hexdigest()
+            path = chunk_path(store, name)
+            if not os.path.exists(path):
+                if not os.path.isdir(os.path.dirname(path)):
+                    try:
+                        os.makedirs(os.path.dirname(path))
+                    except OSError:
+                        # Another backup may have just created it.
+                        if not os.path.isdir(os.path.dirname(path)):
+                            raise
+                data = zlib.compress(chunk)
+                # Write the chunk under a unique name and rename it into
+                # place, so that a chunk is never seen half written.
+                partial = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+                c = open(partial, 'wb')
+                c.write(data)
+                c.close()
+                os.rename(partial, path)
+                written += len(data)
+            recipe.write('%s %d\n' % (name, len(chunk)))
+            size += len(chunk)
+    except Exception:
+        recipe.close()
+        os.remove(temporary)
+        raise
+    finally:
+        f.close()
+    recipe.close()
+    os.rename(temporary, recipe_path)
+    os.remove(backup_path)
+    record_metric('store', database, started, bytes_in=size,
+                  bytes_out=written, host=host)
+    report('Stored %d bytes as %d new bytes.' % (size, written))
+    return recipe_path
+
+
+def read_checksums(checksum_file, name):
+    """
+    Return a list of (hash object, expected hex digest) tuples for the given
+    file name from a checksum file.
+    """
+    expected = []
+    for line in open(checksum_file, 'r'):
+        match = re.match(r'^([\w-]+)\((.+)\)= ([0-9a-f]+)$', line.strip())
+        if match and match.group(2) == name:
+            expected.append((hashlib.new(match.group(1).lower()),
+                             match.group(3)))
+    return expected
+
+
+def read_chunks(recipe_path, store):
+    """
+    Yield each chunk listed in a .chunks file, checking it against its hash.
+    """
+    for line in open(recipe_path, 'r'):
+        chunk_name, length = line.split()
+        try:
+            c = open(chunk_path(store, chunk_name), 'rb')
+        except IOError:
+            raise BackupError('Chunk %s is missing' % (chunk_name))
+        try:
+            chunk = zlib.decompress(c.read())
+        except zlib.error:
+            raise BackupError('Chunk %s is damaged' % (chunk_name))
+        finally:
+            c.close()
+        if (len(chunk) != int(length) or
+                hashlib.sha256(chunk).hexdigest() != chunk_name):
+            raise BackupError('Chunk %s does not match its hash' %
+                              (chunk_name))
+        yield chunk
+
+
+def restore_backup(recipe_path, store):
+    """
+    Rebuild a dump from the store, next to its list of chunks. Check the hash
+    of each chunk, and of the whole dump against its checksum file, if there
+    is one. Return the path of the dump.
+    """
+    import uuid
+    path = recipe_path[:-len('.chunks')]
+    name = os.path.basename(path)
+    # Find the digests to check the dump against.
+    expected = []
+    checksum_file = '%s.%s' % (path, HASH)
+    if HASH and os.path.exists(checksum_file):
+        expected = read_checksums(checksum_file, name)
+
+    temporary = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+    output = open(temporary, 'wb')
+    try:
+        for chunk in read_chunks(recipe_path, store):
+            for digest, value in expected:
+                digest.update(chunk)
+            output.write(chunk)
+    except Exception:
+        output.close()
+        os.remove(temporary)
+        raise
+    output.close()
+    for digest, value in expected:
+        if digest.hexdigest() != value:
+            os.remove(temporary)
+            raise BackupError('%s does not match its hash' % (name))
+    os.rename(temporary, path)
+    return path
+
+
+def find_backup(base):
+    """
+    Given the path of a dump without any extensions, return the path of the
+    backup that was written for it, or None.
+    """
+    candidates = [base, base + '.chunks']
+    for extension in sorted(set(COMPRESSORS.values())):
+        candidates.extend([base + extension, base + extension + '.gpg'])
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def verify_backup(checksum_path, key=None, store=None):
+    """
+    Check a backup against its checksum file, decrypting and decompressing it
+    as needed, without writing it anywhere. Return the path of the backup and
+    the number of bytes checked.
+    """
+    base = checksum_path[:-len(HASH) - 1]
+    path = find_backup(base)
+    if not path:
+        raise BackupError('No backup found for %s' % (checksum_path))
+    expected = read_checksums(checksum_path, os.path.basename(base))
+    if not expected:
+        raise BackupError('%s has no hash for %s' %
+                          (checksum_path, os.path.basename(base)))
+
+    size = 0
+    if path.endswith('.chunks'):
+        if not store:
+            raise BackupError('No store specified for %s' % (path))
+        for chunk in read_chunks(path, store):
+            for digest, value in expected:
+                digest.update(chunk)
+            size += len(chunk)
+    elif path == base:
+        f = open(path, 'rb')
+        try:
+            size = copy_stream(f, None, [digest for digest, value in
+                                         expected])
+        finally:
+            f.close()
+    else:
+        # Decrypt and decompress the backup in a pipeline, hashing what comes
+        # out of the end of it.
+        stages = []
+        name = path
+        if name.endswith('.gpg'):
+            if not key:
+                raise BackupError('No encryption key specified for %s' %
+                                  (path))
+            stages.append([GPG, '--batch', '-q', '-d', '--passphrase', key])
+            name = name[:-len('.gpg')]
+        for compressor, extension in sorted(COMPRESSORS.items()):
+            if name.endswith(extension):
+                binary = compressor_command(compressor)[0]
+                if compressor == 'pigz':
+                    binary = GZIP
+                stages.append([binary, '-d', '-c'])
+                break
+        processes = []
+        stdin = open(path, 'rb')
+        try:
+            for stage in stages:
+                process = start_process(stage, stdin=stdin,
+                                        stdout=subprocess.PIPE)
+                stdin.close()
+                processes.append(process)
+                stdin = process.stdout
+            size = copy_stream(stdin, None, [digest for digest, value in
+                                             expected])
+        finally:
+            stdin.close()
+            errors = []
+            for stage, process in zip(stages, processes):
+                if process.wait() != 0:
+                    errors.append('%s returned non-zero status' % (stage[0]))
+        if errors:
+            raise BackupError('%s: %s' % (path, ', '.join(errors)))
+
+    for digest, value in expected:
+        if digest.hexdigest() != value:
+            raise BackupError('%s does not match its hash' % (path))
+    return path, size
+
+
+def verify_directory(directory, key=None, store=None, jobs=1):
+    """
+    Check every backup in the directory against its checksum file, using the
+    given number of jobs. Backups which have not changed since they were last
+    checked are skipped. Return a list of (checksum path, backup path, bytes
+    checked, error) tuples, where the backup path is None for skipped backups.
+    """
+    from multiprocessing.pool import ThreadPool
+    cache = load_journal(VERIFY_CACHE) if VERIFY_CACHE else {}
+    lock = threading.Lock()
+    checksum_paths = sorted([os.path.join(directory, name) for name in
+                             os.listdir(directory)
+                             if HASH and name.endswith('.' + HASH)])
+
+    def check(checksum_path):
+        """Check a single backup, unless it has not changed."""
+        path = find_backup(checksum_path[:-len(HASH) - 1])
+        if path:
+            st = os.stat(path)
+            signature = [st.st_size, st.st_mtime,
+                         file_digest(checksum_path)]
+            if cache.get(os.path.abspath(path)) == signature:
+                return (checksum_path, None, 0, None)
+        try:
+            path, size = verify_backup(checksum_path, key, store)
+        except (BackupError, EnvironmentError) as error:
+            return (checksum_path, path, 0, str(error))
+        with lock:
+            cache[os.path.abspath(path)] = signature
+        return (checksum_path, path, size, None)
+
+    pool = ThreadPool(max(1, min(jobs, len(checksum_paths) or 1)))
+    try:
+        results = pool.map(check, checksum_paths)
+    finally:
+        pool.close()
+        pool.join()
+    if VERIFY_CACHE:
+        directory = os.path.dirname(VERIFY_CACHE)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        save_journal(VERIFY_CACHE, cache)
+    return results
+
+
+def collect_store(store, directories):
+    """
+    Remove every chunk in the store that is not listed by a .chunks file in
+    any of the given directories. This must not be run while a backup is being
+    stored. Return the number of chunks and bytes removed.
+    """
+    used = set()
+    for directory in directories:
+        for name in os.listdir(directory):
+            if name.endswith('.chunks') or '.chunks.' in name:
+                for line in open(os.path.join(directory, name), 'r'):
+                    used.add(line.split()[0])
+    count = 0
+    size = 0
+    root = os.path.join(store, 'chunks')
+    if not os.path.isdir(root):
+        return count, size
+    for prefix in os.listdir(root):
+        for name in os.listdir(os.path.join(root, prefix)):
+            if name not in used and not name.endswith('.tmp'):
+                path = os.path.join(root, prefix, name)
+                size += os.path.getsize(path)
+                os.remove(path)
+                count += 1
+    return count, size
+
+
+def update_pgpass(database, user, password):
+    """
+    Make sure that the database is in the PostgreSQL Password File, adding it
+    if necessary.
+    """
+    PGPASS_LOCK.acquire()
+    try:
+        # Check for the current database in the PostgreSQL Password File.
+        try:
+            # If the file exists, open it.
+            f = open(POSTGRESQL_FILE, 'r')
+        except IOError:
+            # If the file does not exist, make sure we were passed a password.
+            try:
+                pgpass = '*:*:' + database + ':' + user + ':' + password + '\n'
+            except TypeError:
+                raise BackupError('No database password specified.')
+            # Create the file and add the current database.
+            f = open(POSTGRESQL_FILE, 'w')
+            f.write(pgpass)
+            f.close()
+            # Permissions must be 0600.
+            os.chmod(POSTGRESQL_FILE, 0600)
+        else:
+            # Check if the current database is in the file.
+            match = False
+            for line in f:
+                search = line.find(':' + database + ':')
+                if search != -1:
+                    match = True
+                    break
+            # Close the file so that we can reopen it for appending.
+            f.close()
+            # If the database is not in the file, add it.
+            if match is False:
+                # Make sure we were passed the password.
+                try:
+                    pgpass = ('*:*:' + database + ':' + user + ':' + password +
+                              '\n')
+                except TypeError:
+                    raise BackupError('No database password specified.')
+                f = open(POSTGRESQL_FILE, 'a')
+                f.write(pgpass)
+                f.close()
+    finally:
+        PGPASS_LOCK.release()
+
+
+PG_FORMATS = {
+    'plain': '',
+    'custom': '.dump',
+    'directory': '.tar',
+}
+
+
+# Explain why a tables dump was refused.
+TABLE_SNAPSHOTS_ERROR = ('The tables format reads each table from its own '
+                         'snapshot, so the tables may not match each other. '
+                         'Use --mysql-table-snapshots or set '
+                         'mysql_table_snapshots to allow it.')
+
+MYSQL_FORMATS = {
+    'single': '',
+    'tables': '.tar',
+}
+
+
+def package_command(path):
+    """Return the command that writes the directory as a tar file."""
+    return [TAR, '-cf', '-', '-C', os.path.dirname(path),
+            os.path.basename(path)]
+
+
+def dump_directory(command, path, database, jobs, host=None):
+    """
+    Dump a PostgreSQL database into the given directory using the given number
+    of connections. Return the command that writes the directory as a tar
+    file to standard output.
+    """
+    started = start_metric()
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    execute(command + ['-Fd', '-j', str(jobs), '-f', path])
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    record_metric('dump', database, started, bytes_out=size, host=host)
+    return package_command(path)
+
+
+def list_tables(login, database):
+    """
+    Return the names of the base tables in a MySQL database, largest first.
+    """
+    query = ('SELECT table_name FROM information_schema.tables '
+             'WHERE table_schema = DATABASE() AND table_type = \'BASE TABLE\' '
+             'ORDER BY data_length + index_length DESC')
+    command = [MYSQL] + login + ['-N', '-B', '-e', query, database]
+    process = start_process(command, stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        raise BackupError('%s returned non-zero status' % (command[0]))
+    return [line for line in output.split('\n') if line]
+
+
+def dump_tables(login, path, database, jobs, host=None):
+    """
+    Dump the schema of a MySQL database, and then the rows of each of its
+    tables using the given number of connections, into the given directory.
+    Write a manifest of the files in restore order. Return the command that
+    writes the directory as a tar file to standard output.
+    """
+    from multiprocessing.pool import ThreadPool
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    tables = list_tables(login, database)
+    dump = [MYSQLDUMP] + login + MYSQLDUMP_OPTIONS
+
+    # The schema must be restored first, so it is dumped first.
+    schema = ('000-schema.sql', dump + ['--no-data', '--routines', '--events',
+                                        database], database)
+    # Number the tables by name, but dump the largest first, so that a large
+    # table is not left running alone at the end.
+    numbers = dict((table, number) for number, table in
+                   enumerate(sorted(tables), 1))
+    rows = [('%03d-%s.sql' % (numbers[table], table),
+             dump + ['--no-create-info', '--skip-triggers', database, table],
+             '%s.%s' % (database, table)) for table in tables]
+
+    def run(entry):
+        """Dump a single file of the database."""
+        name, command, label = entry
+        return dump_backup(command, os.path.join(path, name), label,
+                           host=host)
+
+    digests = {schema[0]: run(schema)}
+    if rows:
+        pool = ThreadPool(max(1, min(jobs, len(rows))))
+        try:
+            digests.update(zip([entry[0] for entry in rows],
+                               pool.map(run, rows)))
+        finally:
+            pool.close()
+            pool.join()
+
+    manifest = open(os.path.join(path, 'MANIFEST'), 'w')
+    for name in sorted(digests):
+        if not digests[name]:
+            manifest.write('%s\n' % (name))
+        for digest in digests[name]:
+            manifest.write('%s(%s)= %s\n' % (digest.name.upper(), name,
+                                               digest.hexdigest()))
+    manifest.close()
+    return package_command(path)
+
+
+def backup_database(db_type, database, host, user, password, directory,
+                    mail=None, key=None, stream=False, compression=None,
+                    pg_format=None, pg_jobs=None, mysql_format=None,
+                    mysql_jobs=None, resume=False, destinations=None,
+                    mysql_table_snapshots=None):
+    """
+    Backup a single database into the given directory, emailing it and sending
+    it to the destinations if requested. Each stage is recorded in a journal
+    as it completes. When resuming, any stage that the journal records as
+    complete, and whose files are intact, is not run again. Return the path of
+    the backup.
+    """
+    compression = compression or COMPRESSION
+    # Check the compression setting before anything is dumped.
+    compressor_command(compression)
+    extension = COMPRESSORS.get(compression.partition(':')[0], '')
+    pg_format = pg_format or PG_FORMAT
+    if pg_format not in PG_FORMATS:
+        raise BackupError('Unsupported PostgreSQL format %s' % (pg_format))
+    mysql_format = mysql_format or MYSQL_FORMAT
+    if mysql_format not in MYSQL_FORMATS:
+        raise BackupError('Unsupported MySQL format %s' % (mysql_format))
+    if mysql_table_snapshots is None:
+        mysql_table_snapshots = MYSQL_TABLE_SNAPSHOTS
+    if db_type == 'mysql' and mysql_format == 'tables' and \
+            not mysql_table_snapshots:
+        raise BackupError(TABLE_SNAPSHOTS_ERROR)
+    # The journal is named without the date, so that a backup may be resumed
+    # on a later day.
+    journal_path = os.path.join(directory, '%s.%s.journal' % (database,
+                                                              db_type))
+    journal = {}
+    if resume:
+        journal = load_journal(journal_path)
+    filename = journal.get('filename') or database + '.' + str(TODAY)
+    journal = {'filename': filename, 'stages': journal.get('stages', {})}
+
+    def done(stage):
+        """Return whether a stage may be skipped."""
+        if resume and stage_complete(journal, stage, directory):
+            report('Resuming after the %s stage.' % (stage))
+            return True
+        return False
+
+    def complete(stage, files, **details):
+        """Record a stage, and the hashes of the files it wrote."""
+        entry = {'files': files}
+        entry.update(details)
+        journal['stages'][stage] = entry
+        save_journal(journal_path, journal)
+
+    def send(path):
+        """
+        Deliver the backup to every target that it has not already been sent
+        to, recording those it has been sent to so that only the others are
+        tried again when resuming.
+        """
+        sent = journal['stages'].get('sending', {}).get('sent', [])
+        sent, errors = deliver(path, database, mail, destinations or [], sent,
+                               host)
+        complete('sending', {}, sent=sent)
+        if errors:
+            raise BackupError('; '.join(errors))
+        complete('delivered', {})
+
+    backup_file = filename + '.' + db_type
+    if db_type == 'postgresql':
+        backup_file = backup_file + PG_FORMATS[pg_format]
+    if db_type == 'mysql':
+        backup_file = backup_file + MYSQL_FORMATS[mysql_format]
+    checksum_file = '%s.%s' % (backup_file, HASH)
+    # Keep the name that bzip2 tar files have always had.
+    if extension == '.bz2':
+        tar_file = filename + '.tar.bz'
+    else:
+        tar_file = filename + '.tar' + extension
+    crypt_file = tar_file + '.gpg'
+
+    # When streaming, the only file written is the compressed (and, if a key
+    # was given, encrypted) dump.
+    stream_file = backup_file + extension
+    if key:
+        stream_file = stream_file + '.gpg'
+
+    # Build the dump command.
+    if db_type == 'mysql':
+        login = ['-u', user, '-p' + password, '-h', host]
+        command = [MYSQLDUMP] + login + MYSQLDUMP_OPTIONS + [database]
+    if db_type == 'postgresql':
+        update_pgpass(database, user, password)
+        command = [PG_DUMP, '-h', host, '-U', user, database]
+        if pg_format == 'custom':
+            command.append('-Fc')
+
+    # Directory dumps are written to disk first, and then packaged with tar.
+    dump_path = None
+    stage = 'dump'
+    if ((db_type == 'postgresql' and pg_format == 'directory') or
+            (db_type == 'mysql' and mysql_format == 'tables')):
+        dump_path = os.path.join(directory, filename + '.' + db_type + '.d')
+        stage = 'package'
+
+    if stream:
+        backup_name = stream_file
+    else:
+        backup_name = backup_file
+    backup_path = os.path.join(directory, backup_name)
+
+    if done('dumped'):
+        checksums = journal['stages']['dumped']['checksums']
+    else:
+        # A new dump makes every later stage stale.
+        journal['stages'] = {}
+        try:
+            if dump_path and db_type == 'postgresql':
+                command = dump_directory(command, dump_path, database,
+                                         pg_jobs or PG_JOBS, host)
+            elif dump_path:
+                command = dump_tables(login, dump_path, database,
+                                      mysql_jobs or MYSQL_JOBS, host)
+            if stream:
+                # Stream the dump straight into the compressed file, hashing
+                # the dump and the file inline.
+                digests, hexdigest = stream_backup(command, backup_path,
+                                                   database, key, compression,
+                                                   host)
+                recorded = ('sha256', hexdigest)
+            else:
+                # Backup the database, hashing the dump as it is written. The
+                # hash of a plain dump is also the hash of the file, so the
+                # journal only needs a hash of its own if HASH is disabled.
+                journal_digests = [] if HASH else [hashlib.sha256()]
+                digests = dump_backup(command, backup_path, database, stage,
+                                      host, journal_digests)
+                first = (digests or journal_digests)[0]
+                recorded = (first.name, first.hexdigest())
+        finally:
+            if dump_path and os.path.exists(dump_path):
+                shutil.rmtree(dump_path)
+
+        # Check if backup file is empty.
+        if os.stat(backup_path).st_size == 0:
+            os.remove(backup_path)
+            raise BackupError('%s is empty' % (backup_path))
+
+        checksums = [(digest.name, digest.hexdigest()) for digest in digests]
+        complete('dumped', {backup_name: recorded}, checksums=checksums)
+
+    # Write the hash file, if requested.
+    if checksums and not done('hashed'):
+        checksum_path = os.path.join(directory, checksum_file)
+        complete('hashed', {checksum_file: ('sha256', write_checksums(
+            checksum_path, backup_file, checksums))})
+
+    report('Backup successful!')
+
+    if (mail or destinations) and stream:
+        # The streamed file is already encrypted, and is kept as the local
+        # backup.
+        if not done('delivered'):
+            send(backup_path)
+        # Only the manifest of the mailed parts is left to clean up.
+        if os.path.exists(backup_path + '.manifest'):
+            os.remove(backup_path + '.manifest')
+    elif mail or destinations:
+        tar_path = os.path.join(directory, tar_file)
+        crypt_path = os.path.join(directory, crypt_file)
+        tar_items = [backup_file]
+        if checksums:
+            tar_items.append(checksum_file)
+        # The compressed and encrypted files are kept until the backup has
+        # been delivered, so that a failed delivery may be resumed.
+        if not done('delivered'):
+            if not done('encrypted'):
+                if not done('compressed'):
+                    # Compress the backup and hash file, hashing the tar file
+                    # as it is written.
+                    started = start_metric()
+                    recorded = execute_into(
+                        [TAR, '-cf', '-', '--use-compress-program',
+                         ' '.join(compressor_command(compression)), '-C',
+                         directory] + tar_items, tar_path)
+                    record_metric('compress', database, started,
+                                  bytes_in=sum([os.path.getsize(
+                                      os.path.join(directory, item))
+                                      for item in tar_items]),
+                                  bytes_out=os.path.getsize(tar_path),
+                                  host=host)
+                    complete('compressed', {tar_file: ('sha256', recorded)})
+                # Encrypt the compressed file, hashing it as it is written.
+                started = start_metric()
+                recorded = execute_into([GPG, '--batch', '-cao', '-',
+                                         '--passphrase', key, tar_path],
+                                        crypt_path)
+                record_metric('encrypt', database, started,
+                              bytes_in=os.path.getsize(tar_path),
+                              bytes_out=os.path.getsize(crypt_path),
+                              host=host)
+                complete('encrypted', {crypt_file: ('sha256', recorded)})
+            send(crypt_path)
+        # Clean up
+        for path in (crypt_path, tar_path, crypt_path + '.manifest'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Move a plain dump into the store, once it is no longer needed for mail.
+    if STORE and not stream:
+        backup_path = store_backup(backup_path, STORE, database, host)
+
+    # Every stage is complete, so there is nothing left to resume.
+    os.remove(journal_path)
+    return backup_path
+
+
+def read_batch(config_file):
+    """
+    Read a batch configuration file. Return a list of dictionaries of options,
+    one for each database, and a dictionary of per-host job limits.
+    """
+    config = ConfigParser.RawConfigParser()
+    if not config.read(config_file):
+        print 'Could not read %s' % (config_file)
+        sys.exit(2)
+
+    def get(section, option, default=None):
+        """Get an option from the section, falling back to the settings."""
+        for name in (section, 'Settings'):
+            if config.has_section(name) and config.has_option(name, option):
+                return config.get(name, option)
+        return default
+
+    global JOBS, HOST_JOBS, METRICS_FILE, PROMETHEUS_FILE, MAIL_SPLIT_SIZE
+    global MAIL_CONNECTIONS, COMPRESSION_THREADS, STORE, THROTTLE
+    global MAIL_THROTTLE, NICE, IONICE_CLASS, IONICE_LEVEL
+    global DESTINATION_ATTEMPTS, DESTINATION_DELAY, S3_ENDPOINT
+    if config.has_option('Settings', 'jobs'):
+        JOBS = config.getint('Settings', 'jobs')
+    if config.has_option('Settings', 'host_jobs'):
+        HOST_JOBS = config.getint('Settings', 'host_jobs')
+    if config.has_option('Settings', 'metrics_file'):
+        METRICS_FILE = config.get('Settings', 'metrics_file')
+    if config.has_option('Settings', 'prometheus_file'):
+        PROMETHEUS_FILE = config.get('Settings', 'prometheus_file')
+    if config.has_option('Settings', 'mail_split_size'):
+        MAIL_SPLIT_SIZE = config.get('Settings', 'mail_split_size')
+    if config.has_option('Settings', 'mail_connections'):
+        MAIL_CONNECTIONS = config.getint('Settings', 'mail_connections')
+    if config.has_option('Settings', 'compression_threads'):
+        COMPRESSION_THREADS = config.getint('Settings', 'compression_threads')
+    if config.has_option('Settings', 'store'):
+        STORE = config.get('Settings', 'store')
+    if config.has_option('Settings', 'throttle'):
+        THROTTLE = config.get('Settings', 'throttle')
+    if config.has_option('Settings', 'mail_throttle'):
+        MAIL_THROTTLE = config.get('Settings', 'mail_throttle')
+    if config.has_option('Settings', 'nice'):
+        NICE = config.getint('Settings', 'nice')
+    if config.has_option('Settings', 'ionice_class'):
+        IONICE_CLASS = config.getint('Settings', 'ionice_class')
+    if config.has_option('Settings', 'ionice_level'):
+        IONICE_LEVEL = config.getint('Settings', 'ionice_level')
+    if config.has_option('Settings', 'destination_attempts'):
+        DESTINATION_ATTEMPTS = config.getint('Settings',
+                                             'destination_attempts')
+    if config.has_option('Settings', 'destination_delay'):
+        DESTINATION_DELAY = config.getint('Settings', 'destination_delay')
+    if config.has_option('Settings', 's3_endpoint'):
+        S3_ENDPOINT = config.get('Settings', 's3_endpoint')
+
+    databases = []
+    host_jobs = {}
+    for section in config.sections():
+        if section == 'Settings':
+            continue
+        # Host sections set the job limit for a single host. Without a jobs
+        # option, the host keeps the HOST_JOBS limit.
+        if section.startswith('Host '):
+            if config.has_option(section, 'jobs'):
+                try:
+                    host_jobs[section[5:].strip()] = config.getint(section,
+                                                                   'jobs')
+                except ValueError:
+                    print '%s: The job limit must be a number.' % (section)
+                    sys.exit(2)
+            continue
+        options = {
+            'name': section,
+            'type': (get(section, 'type') or '').lower(),
+            'database': get(section, 'database', section),
+            'host': get(section, 'host', 'localhost'),
+            'password': get(section, 'password'),
+            'directory': get(section, 'directory'),
+            'key': get(section, 'key'),
+            'compression': get(section, 'compression', COMPRESSION),
+            'pg_format': get(section, 'pg_format', PG_FORMAT).lower(),
+            'pg_jobs': int(get(section, 'pg_jobs', PG_JOBS)),
+            'mysql_format': get(section, 'mysql_format', MYSQL_FORMAT).lower(),
+            'mysql_jobs': int(get(section, 'mysql_jobs', MYSQL_JOBS)),
+            'mysql_table_snapshots': get(
+                section, 'mysql_table_snapshots',
+                str(MYSQL_TABLE_SNAPSHOTS)).lower() in
+                ('1', 'yes', 'true', 'on'),
+            'stream': get(section, 'stream', 'false').lower() in
+                ('1', 'yes', 'true', 'on'),
+        }
+        options['user'] = get(section, 'user', options['database'])
+        options['mail'] = get(section, 'mail')
+        if options['mail']:
+            options['mail'] = options['mail'].split(',')
+        options['destinations'] = [destination.strip() for destination in
+                                   get(section, 'destinations', '').split(',')
+                                   if destination.strip()]
+
+        # Check to make sure all required options have been given.
+        error = None
+        if options['type'] not in SUPPORTED_DATABASES:
+            error = 'Unsupported database type specified.'
+        elif not options['directory']:
+            error = 'No backup directory specified.'
+        elif (options['mail'] or options['destinations']) and \
+                not options['key']:
+            error = 'No encryption key specified.'
+        elif options['pg_format'] not in PG_FORMATS:
+            error = 'Unsupported PostgreSQL format specified.'
+        elif options['mysql_format'] not in MYSQL_FORMATS:
+            error = 'Unsupported MySQL format specified.'
+        elif options['type'] == 'mysql' and \
+                options['mysql_format'] == 'tables' and \
+                not options['mysql_table_snapshots']:
+            error = TABLE_SNAPSHOTS_ERROR
+        elif not options['password'] and options['type'] == 'mysql':
+            error = 'No database password specified.'
+        else:
+            try:
+                check_destinations(options['destinations'])
+            except BackupError as destination_error:
+                error = '%s.' % (destination_error)
+        if error:
+            print '%s: %s' % (section, error)
+            sys.exit(2)
+        databases.append(options)
+
+    return databases, host_jobs
+
+
+def run_batch(databases, jobs, host_jobs):
+    """
+    Back up the given databases, running up to the given number of jobs at
+    once and no more than each host's job limit against any one host. Return
+    a list of (options, path, error, seconds) tuples.
+    """
+    from multiprocessing.pool import ThreadPool
+    locks = {}
+    for options in databases:
+        if options['host'] not in locks:
+            limit = host_jobs.get(options['host'], HOST_JOBS)
+            locks[options['host']] = threading.BoundedSemaphore(limit)
+
+    def run(options):
+        """Back up a single database, holding a slot on its host."""
+        lock = locks[options['host']]
+        lock.acquire()
+        started = start_metric()
+        try:
+            try:
+                if not os.path.exists(options['directory']):
+                    os.makedirs(options['directory'])
+                path = backup_database(options['type'], options['database'],
+                                       options['host'], options['user'],
+                                       options['password'],
+                                       options['directory'], options['mail'],
+                                       options['key'], options['stream'],
+                                       options['compression'],
+                                       options['pg_format'],
+                                       options['pg_jobs'],
+                                       options['mysql_format'],
+                                       options['mysql_jobs'], RESUME,
+                                       options['destinations'],
+                                       options['mysql_table_snapshots'])
+            except (BackupError, EnvironmentError) as error:
+                record_metric('total', options['database'], started,
+                              error=str(error), host=options['host'])
+                return (options, None, str(error), time.time() - started[0])
+        finally:
+            lock.release()
+        record_metric('total', options['database'], started,
+                      host=options['host'])
+        return (options, path, None, time.time() - started[0])
+
+    # Start each host's first database before any host's second, so that
+    # workers do not all queue up behind a single host.
+    counts = {}
+    ordered = []
+    for options in databases:
+        count = counts.get(options['host'], 0)
+        counts[options['host']] = count + 1
+        ordered.append((count, len(ordered), options))
+    ordered.sort()
+
+    pool = ThreadPool(max(1, min(jobs, len(databases))))
+    try:
+        return pool.map(run, [options for rank, index, options in ordered])
+    finally:
+        pool.close()
+        pool.join()
+
+# Define the supported database types
+SUPPORTED_DATABASES = ('mysql', 'postgresql',)
+
+# Only one thread at a time may update the PostgreSQL Password File.
+PGPASS_LOCK = threading.Lock()
+
+# Progress messages are suppressed in batch mode in favour of a summary.
+QUIET = False
+
+# Hold the metrics recorded during this run.
+METRICS = []
+
+# Every dump, and every message, shares a single limit on its rate.
+DUMP_BUCKET = TokenBucket()
+MAIL_BUCKET = TokenBucket()
+
+# tarsnapper.py is loaded by the first backup sent to Tarsnap.
+TARSNAPPER_MODULE = None
+TARSNAPPER_LOCK = threading.Lock()
+
+def main():
+    """Back up a database, or run any of the other modes, as requested."""
+    global TYPE, DATABASE, HOST, USER, PASSWORD, DIRECTORY, MAIL, KEY, STREAM
+    global CONFIG, JOIN, BENCHMARK, RESTORE, COLLECT, RESUME, VERIFY
+    global COMPRESSION, PG_FORMAT, PG_JOBS, MYSQL_FORMAT, MYSQL_JOBS, STORE
+    global THROTTLE, QUIET, DESTINATIONS, MYSQL_TABLE_SNAPSHOTS
+
+    # Write out the metrics when the run ends, however it ends.
+    atexit.register(write_metrics)
+
+    # Get any flags from the user
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "t:d:h:u:p:f:m:D:k:sc:J:z:b:F:j:M:T:S:R:Cl:rV:h",
+            ["type=", "database=", "host=", "user=", "password=", "directory=",
+            "mail=", "destination=", "key=", "stream", "config=", "join=",
+            "compression=", "benchmark=", "pg-format=", "pg-jobs=", "mysql-format=",
+            "mysql-jobs=", "store=", "restore=", "collect", "throttle=", "resume",
+            "verify=", "mysql-table-snapshots", "help"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif opt in ("-t", "--type"):
+            TYPE = arg.lower()
+        elif opt in ("-d", "--database"):
+            DATABASE = arg
+        elif opt in ("-h", "--host"):
+            HOST = arg
+        elif opt in ("-u", "--user"):
+            USER = arg
+        elif opt in ("-p", "--password"):
+            PASSWORD = arg
+        elif opt in ("-f", "--directory"):
+            DIRECTORY = arg
+        elif opt in ("-m", "--mail"):
+            MAIL = arg.split(',')
+        elif opt in ("-D", "--destination"):
+            DESTINATIONS = DESTINATIONS + arg.split(',')
+        elif opt in ("-k", "--key"):
+            KEY = arg
+        elif opt in ("-s", "--stream"):
+            STREAM = True
+        elif opt in ("-c", "--config"):
+            CONFIG = arg
+        elif opt in ("-J", "--join"):
+            JOIN = arg
+        elif opt in ("-z", "--compression"):
+            COMPRESSION = arg.lower()
+        elif opt in ("-b", "--benchmark"):
+            BENCHMARK = arg
+        elif opt in ("-F", "--pg-format"):
+            PG_FORMAT = arg.lower()
+        elif opt in ("-j", "--pg-jobs"):
+            PG_JOBS = int(arg)
+        elif opt in ("-M", "--mysql-format"):
+            MYSQL_FORMAT = arg.lower()
+        elif opt in ("-T", "--mysql-jobs"):
+            MYSQL_JOBS = int(arg)
+        elif opt == "--mysql-table-snapshots":
+            MYSQL_TABLE_SNAPSHOTS = True
+        elif opt in ("-S", "--store"):
+            STORE = arg
+        elif opt in ("-R", "--restore"):
+            RESTORE = arg
+        elif opt in ("-C", "--collect"):
+            COLLECT = True
+        elif opt in ("-l", "--throttle"):
+            THROTTLE = arg
+        elif opt in ("-r", "--resume"):
+            RESUME = True
+        elif opt in ("-V", "--verify"):
+            VERIFY = arg
+
+    # Benchmark the compressors on a sample dump, if requested.
+    if BENCHMARK:
+        if ('-z', COMPRESSION) in opts or ('--compression', COMPRESSION) in opts:
+            compressions = [COMPRESSION]
+        else:
+            compressions = sorted(COMPRESSORS)
+        benchmark_compression(BENCHMARK, compressions)
+        sys.exit()
+
+    # Check and join the parts of an emailed backup, if requested.
+    if JOIN:
+        try:
+            print 'Joined %s' % (join_parts(JOIN))
+        except (BackupError, EnvironmentError) as error:
+            print error
+            print 'Join failed!'
+            sys.exit(1)
+        sys.exit()
+
+    # Check every backup in a directory, if requested.
+    if VERIFY:
+        started = time.time()
+        checked = 0
+        skipped = 0
+        failed = 0
+        size = 0
+        for checksum_path, path, checked_size, error in verify_directory(
+                VERIFY, KEY, STORE, VERIFY_JOBS):
+            if error:
+                failed += 1
+                print 'FAILED %s: %s' % (checksum_path, error)
+            elif not path:
+                skipped += 1
+            else:
+                checked += 1
+                size += checked_size
+                report('OK %s' % (path))
+        seconds = max(time.time() - started, 0.001)
+        print 'Checked %d backups (%.1f MB at %.1f MB/s), skipped %d unchanged, ' \
+              '%d failed.' % (checked, size / 1048576.0,
+                              size / 1048576.0 / seconds, skipped, failed)
+        if failed:
+            sys.exit(1)
+        sys.exit()
+
+    # Rebuild a dump from the store, or remove unused chunks from it, if
+    # requested. The store may be given in the configuration file.
+    if RESTORE or COLLECT:
+        directories = []
+        if CONFIG:
+            directories = sorted(set([options['directory'] for options in
+                                      read_batch(CONFIG)[0]]))
+        if DIRECTORY:
+            directories.append(DIRECTORY)
+        if not STORE:
+            print 'No store specified.'
+            usage()
+            sys.exit(2)
+        if COLLECT and not directories:
+            print 'No backup directory specified.'
+            usage()
+            sys.exit(2)
+        try:
+            if RESTORE:
+                print 'Restored %s' % (restore_backup(RESTORE, STORE))
+            else:
+                count, size = collect_store(STORE, directories)
+                print 'Removed %d chunks (%d bytes).' % (count, size)
+        except (BackupError, EnvironmentError, zlib.error) as error:
+            print error
+            if RESTORE:
+                print 'Restore failed!'
+            else:
+                print 'Collect failed!'
+            sys.exit(1)
+        sys.exit()
+
+    # In batch mode, back up every configured database and print a summary.
+    if CONFIG:
+        QUIET = True
+        databases, host_jobs = read_batch(CONFIG)
+        try:
+            lower_priority()
+        except BackupError as error:
+            print error
+            sys.exit(1)
+        failed = 0
+        for options, path, error, seconds in run_batch(databases, JOBS, host_jobs):
+            if error:
+                failed += 1
+                print '%s: FAILED (%s)' % (options['name'], error)
+            else:
+                print '%s: OK %s (%.1fs)' % (options['name'], path, seconds)
+        print '%d of %d backups successful.' % (len(databases) - failed,
+                                                len(databases))
+        if failed:
+            sys.exit(1)
+        sys.exit()
+
+    # Check to make sure all required options have been given.
+    if not DATABASE:
+        print 'No database specified.'
+        usage()
+        sys.exit(2)
+    if not TYPE:
+        print 'No database type specified.'
+        usage()
+        sys.exit(2)
+    if not DIRECTORY:
+        print 'No backup directory specified.'
+        usage()
+        sys.exit(2)
+    if (MAIL or DESTINATIONS) and not KEY:
+        print 'No encryption key specified.'
+        usage()
+        sys.exit(2)
+    try:
+        check_destinations(DESTINATIONS)
+    except BackupError as error:
+        print error
+        sys.exit(2)
+
+    # Make sure the specified database type is specified.
+    if TYPE not in SUPPORTED_DATABASES:
+        print 'Unsupported database type specified. Currently only MySQL and PostgreSQL are supported.'
+        sys.exit(2)
+    if PG_FORMAT not in PG_FORMATS:
+        print 'Unsupported PostgreSQL format specified. Use plain, custom or directory.'
+        sys.exit(2)
+    if MYSQL_FORMAT not in MYSQL_FORMATS:
+        print 'Unsupported MySQL format specified. Use single or tables.'
+        sys.exit(2)
+    if TYPE == 'mysql' and MYSQL_FORMAT == 'tables' and \
+            not MYSQL_TABLE_SNAPSHOTS:
+        print TABLE_SNAPSHOTS_ERROR
+        sys.exit(2)
+
+    # If a database user was not specified, assume that the name of the database is
+    # also the name of the user.
+    if not USER:
+        USER = DATABASE
+        print 'No database user specified. Assuming that the name of the database is also the username.'
+
+    # If a database hostname was not specified, assume that it is localhost.
+    if not HOST:
+        HOST = 'localhost'
+        print 'No hostname specified. Assuming that the host is localhost.'
+
+    # Create the backup directory if it doesn't exist
+    if not os.path.exists(DIRECTORY):
+        try:
+            print 'Creating directory %s...' % (DIRECTORY)
+            os.makedirs(DIRECTORY)
+        except OSError:
+            print 'Could not create directory %s' % (DIRECTORY)
+            sys.exit(1)
+
+    # If the type is MySQL, a password is required.
+    if not PASSWORD and TYPE == 'mysql':
+        print 'No database password specified.'
+        usage()
+        sys.exit(2)
+
+    # Test directory permissions
+    try:
+        test = open(os.path.join(DIRECTORY, '.test'), 'wb')
+    except IOError:
+        print 'Cannot write to %s' % (DIRECTORY)
+        sys.exit(1)
+    else:
+        test.close()
+        os.remove(os.path.join(DIRECTORY, '.test'))
+
+    # Perform the backup
+    started = start_metric()
+    try:
+        lower_priority()
+        backup_database(TYPE, DATABASE, HOST, USER, PASSWORD, DIRECTORY, MAIL, KEY,
+                        STREAM, COMPRESSION, PG_FORMAT, PG_JOBS, MYSQL_FORMAT,
+                        MYSQL_JOBS, RESUME, DESTINATIONS)
+    except BackupError as error:
+        record_metric('total', DATABASE, started, error=str(error),
+                      host=HOST)
+        print error
         sys.exit(1)
-    s.login(SMTP_USER, SMTP_PASS)
-    s.sendmail(FROM, MAIL, msg.as_string())
-    s.quit()
+    record_metric('total', DATABASE, started, host=HOST)
 
-    print '\tMessage sent!'
 
-    # Clean up
-    os.remove(crypt_file)
-    os.remove(tar_file)
+if __name__ == '__main__':
+    main()
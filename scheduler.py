@@ -0,0 +1,443 @@
+#! /usr/bin/env python
+#
+# A Python daemon to run tarsnapper.py and db-backup.py on a schedule.
+#
+# Each job in the job file runs one of the scripts, or any other command, every
+# so often. Jobs may be limited in how many of them run at once, both overall
+# and by the resources they use, such as CPU, disk or upload bandwidth, so that
+# backups do not fight each other. A job is never run twice at once, and runs
+# that were missed, because the job was still running, was waiting on a
+# resource or the scheduler was not running, are coalesced into one.
+#
+# The state of every job may be read from a local socket with --status, and a
+# job may be run straight away with --run NAME.
+#
+# A sample job file, scheduler.conf.sample, should have been included with this
+# distribution.
+#
+# Requires Python 2.7 or greater.
+#
+# Author:  Pig Monkey (pm@pig-monkey.com)
+# Website: https://github.com/pigmonkey/backups
+#
+###############################################################################
+import datetime
+import json
+import os
+import random
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import ConfigParser
+import SocketServer
+import argparse
+
+# Set the location of the job file.
+CONFIG = os.path.expanduser('~/.backup-scheduler.conf')
+
+# Set the locations of the scripts.
+TARSNAPPER = '/usr/local/bin/tarsnapper.py'
+DB_BACKUP = '/usr/local/bin/db-backup.py'
+
+# Set the number of jobs that may run at once.
+JOBS = 2
+
+# Set the number of jobs using each resource that may run at once. A resource
+# which is not listed here may be used by any number of jobs.
+RESOURCES = {'cpu': 2, 'disk': 1, 'upload': 1}
+
+# Set the default interval between the runs of each job, in the same format as
+# tarsnapper's maximum age, and the number of seconds to delay each run by, at
+# most. The delay is chosen at random for each run, so that jobs with the same
+# interval do not all start at once.
+INTERVAL = '1d'
+JITTER = 300
+
+# Set the location of the socket that job state is read from, the file that
+# the state is kept in between restarts, and the directory that the output of
+# each job is appended to.
+SOCKET = os.path.expanduser('~/.cache/backup-scheduler/socket')
+STATE = os.path.expanduser('~/.cache/backup-scheduler/state')
+LOG_DIRECTORY = os.path.expanduser('~/.cache/backup-scheduler/logs')
+
+# Stop defining variables here.
+###############################################################################
+
+
+def convert_to_seconds(interval):
+    """
+    Given an interval such as '5d', return the number of seconds it
+    represents. Accepts the same formats as tarsnapper's maximum age.
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    try:
+        return int(interval[:-1]) * units[interval[-1]]
+    except (KeyError, ValueError):
+        raise ValueError('Invalid interval %s' % (interval))
+
+
+def read_jobs(config_file):
+    """
+    Read the job file. Return a dictionary of jobs, keyed by name.
+    """
+    global TARSNAPPER, DB_BACKUP, JOBS, INTERVAL, JITTER, SOCKET, STATE
+    global LOG_DIRECTORY
+    config = ConfigParser.RawConfigParser()
+    if not config.read(config_file):
+        print 'Could not read %s' % (config_file)
+        sys.exit(2)
+    if config.has_section('Settings'):
+        if config.has_option('Settings', 'tarsnapper'):
+            TARSNAPPER = config.get('Settings', 'tarsnapper')
+        if config.has_option('Settings', 'db_backup'):
+            DB_BACKUP = config.get('Settings', 'db_backup')
+        if config.has_option('Settings', 'jobs'):
+            JOBS = config.getint('Settings', 'jobs')
+        if config.has_option('Settings', 'interval'):
+            INTERVAL = config.get('Settings', 'interval')
+        if config.has_option('Settings', 'jitter'):
+            JITTER = config.getint('Settings', 'jitter')
+        if config.has_option('Settings', 'socket'):
+            SOCKET = os.path.expanduser(config.get('Settings', 'socket'))
+        if config.has_option('Settings', 'state'):
+            STATE = os.path.expanduser(config.get('Settings', 'state'))
+        if config.has_option('Settings', 'log_directory'):
+            LOG_DIRECTORY = os.path.expanduser(config.get('Settings',
+                                                          'log_directory'))
+
+    jobs = {}
+    for section in config.sections():
+        if section == 'Settings':
+            continue
+        # Resource sections set the limit of a single resource.
+        if section.startswith('Resource '):
+            RESOURCES[section[9:].strip()] = config.getint(section, 'limit')
+            continue
+
+        def get(option, default=None):
+            """Get an option of the job."""
+            if config.has_option(section, option):
+                return config.get(section, option)
+            return default
+
+        kind = get('type', 'command')
+        arguments = shlex.split(get('arguments', ''))
+        if kind == 'tarsnapper':
+            command = [TARSNAPPER] + arguments
+        elif kind == 'db-backup':
+            command = [DB_BACKUP] + arguments
+        elif kind == 'command':
+            command = shlex.split(get('command', ''))
+        else:
+            print '%s: Unsupported job type %s' % (section, kind)
+            sys.exit(2)
+        if not command:
+            print '%s: No command specified.' % (section)
+            sys.exit(2)
+        try:
+            interval = convert_to_seconds(get('interval', INTERVAL))
+        except ValueError as error:
+            print '%s: %s' % (section, error)
+            sys.exit(2)
+        jobs[section] = {
+            'name': section,
+            'command': command,
+            'interval': interval,
+            'jitter': int(get('jitter', JITTER)),
+            'resources': [resource.strip() for resource in
+                          get('resources', '').split(',') if resource.strip()],
+            'due': None,
+            'next_run': None,
+            'running': False,
+            'waiting': False,
+            'pid': None,
+            'last_start': None,
+            'last_end': None,
+            'last_status': None,
+            'runs': 0,
+            'coalesced': 0,
+        }
+    return jobs
+
+
+def load_state(path):
+    """Return the saved state of the jobs, or an empty dictionary."""
+    try:
+        f = open(path, 'r')
+    except IOError:
+        return {}
+    try:
+        return json.load(f)
+    except ValueError:
+        return {}
+    finally:
+        f.close()
+
+
+def save_state(path, jobs):
+    """Save the state of the jobs, so that it survives a restart."""
+    state = {}
+    for name, job in jobs.items():
+        state[name] = dict((key, job[key]) for key in
+                           ('due', 'last_start', 'last_end', 'last_status',
+                            'runs', 'coalesced'))
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    temporary = path + '.tmp'
+    f = open(temporary, 'w')
+    json.dump(state, f)
+    f.close()
+    os.rename(temporary, path)
+
+
+def schedule(job, due):
+    """Set the time that the job is next due, and when it will next run."""
+    job['due'] = due
+    job['next_run'] = due + random.uniform(0, job['jitter'])
+
+
+class Scheduler(object):
+    """
+    Run jobs when they are due, within the limits on jobs and resources.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.condition = threading.Condition()
+        self.running = 0
+        self.in_use = dict((resource, 0) for resource in RESOURCES)
+        self.stopping = False
+
+    def start_due(self, now):
+        """
+        Start every job that is due and that has the slots it needs, in the
+        order they became due. Return the time that the next job is due.
+        """
+        following = None
+        for job in sorted(self.jobs.values(), key=lambda job: job['next_run']):
+            if job['running'] or job['next_run'] > now:
+                if not job['running']:
+                    if following is None or job['next_run'] < following:
+                        following = job['next_run']
+                continue
+            limited = [resource for resource in job['resources']
+                       if resource in RESOURCES]
+            if self.running >= JOBS or [resource for resource in limited if
+                                        self.in_use[resource] >=
+                                        RESOURCES[resource]]:
+                job['waiting'] = True
+                continue
+            self.running += 1
+            for resource in limited:
+                self.in_use[resource] += 1
+            job['running'] = True
+            job['waiting'] = False
+            # Every run that was due before now is coalesced into this one.
+            missed = max(0, int((now - job['due']) // job['interval']))
+            job['coalesced'] += missed
+            schedule(job, job['due'] + (missed + 1) * job['interval'])
+            thread = threading.Thread(target=self.run, args=(job,))
+            thread.daemon = True
+            thread.start()
+        return following
+
+    def run(self, job):
+        """Run a single job, and release its slots when it finishes."""
+        job['last_start'] = time.time()
+        status = 127
+        # The slots are released however the job ends, even if its log could
+        # not be opened, so that the scheduler can stop.
+        try:
+            log = open(os.path.join(LOG_DIRECTORY, job['name'] + '.log'), 'a')
+            try:
+                log.write('=== %s started %s\n' % (job['name'],
+                                                  datetime.datetime.now()))
+                log.flush()
+                try:
+                    process = subprocess.Popen(job['command'], stdout=log,
+                                               stderr=subprocess.STDOUT,
+                                               close_fds=True)
+                    job['pid'] = process.pid
+                    status = process.wait()
+                except OSError as error:
+                    log.write('Could not run %s: %s\n' % (job['command'][0],
+                                                          error.strerror))
+                log.write('=== %s finished with status %d\n' % (job['name'],
+                                                                status))
+            finally:
+                log.close()
+        finally:
+            with self.condition:
+                job['running'] = False
+                job['pid'] = None
+                job['last_end'] = time.time()
+                job['last_status'] = status
+                job['runs'] += 1
+                self.running -= 1
+                for resource in job['resources']:
+                    if resource in RESOURCES:
+                        self.in_use[resource] -= 1
+                self.condition.notify_all()
+                save_state(STATE, self.jobs)
+
+    def run_now(self, name):
+        """Make a job due straight away. Return False if there is no job."""
+        with self.condition:
+            if name not in self.jobs:
+                return False
+            job = self.jobs[name]
+            if not job['running']:
+                job['due'] = job['next_run'] = time.time()
+            self.condition.notify_all()
+        return True
+
+    def status(self):
+        """Return the state of the scheduler and its jobs."""
+        with self.condition:
+            return {
+                'running': self.running,
+                'jobs_limit': JOBS,
+                'resources': dict((resource, {'in_use': self.in_use[resource],
+                                              'limit': RESOURCES[resource]})
+                                  for resource in RESOURCES),
+                'jobs': dict((name, dict((key, value) for key, value in
+                                         job.items() if key != 'command'))
+                             for name, job in self.jobs.items()),
+            }
+
+    def loop(self):
+        """Run jobs until stopped, and then wait for the running jobs."""
+        with self.condition:
+            while not self.stopping:
+                following = self.start_due(time.time())
+                # Wake up every few seconds, so that a signal to stop is
+                # noticed.
+                if following is None:
+                    timeout = 5
+                else:
+                    timeout = max(0.1, min(5, following - time.time()))
+                self.condition.wait(timeout)
+            while self.running:
+                self.condition.wait(1)
+
+    def stop(self, *args):
+        """Stop starting new jobs."""
+        self.stopping = True
+
+
+class StatusHandler(SocketServer.StreamRequestHandler):
+    """
+    Answer a request on the socket. A request of 'run NAME' makes the job due
+    straight away. Any other request is answered with the state of the jobs as
+    JSON.
+    """
+
+    def handle(self):
+        request = self.rfile.readline().strip()
+        scheduler = self.server.scheduler
+        if request.startswith('run '):
+            if scheduler.run_now(request[4:].strip()):
+                self.wfile.write('ok\n')
+            else:
+                self.wfile.write('no such job\n')
+        else:
+            self.wfile.write(json.dumps(scheduler.status(), indent=2,
+                                        sort_keys=True) + '\n')
+
+
+def serve(scheduler):
+    """Answer requests on the socket from a separate thread."""
+    directory = os.path.dirname(SOCKET)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    if os.path.exists(SOCKET):
+        os.remove(SOCKET)
+    server = SocketServer.ThreadingUnixStreamServer(SOCKET, StatusHandler)
+    server.daemon_threads = True
+    server.scheduler = scheduler
+    os.chmod(SOCKET, 0600)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def request(message):
+    """Send a request to a running scheduler, and print the answer."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(SOCKET)
+    except socket.error as error:
+        print 'Could not connect to %s: %s' % (SOCKET, error)
+        sys.exit(1)
+    client.sendall(message + '\n')
+    answer = []
+    while True:
+        data = client.recv(65536)
+        if not data:
+            break
+        answer.append(data)
+    client.close()
+    sys.stdout.write(''.join(answer))
+
+
+def main():
+    """Run the scheduler, or ask a running scheduler for its state."""
+    global CONFIG
+    # Parse the arguments.
+    parser = argparse.ArgumentParser(description='Run backups on a schedule.')
+    parser.add_argument('-c', '--config', action='store', dest='config',
+                        help='Specify the job file to use.')
+    parser.add_argument('--status', action='store_true',
+                        help='Print the state of a running scheduler.')
+    parser.add_argument('--run', action='store', metavar='NAME',
+                        help='Run a job of a running scheduler straight away.')
+    args = parser.parse_args()
+
+    if args.config:
+        CONFIG = args.config
+    jobs = read_jobs(CONFIG)
+
+    if args.status:
+        request('status')
+        sys.exit()
+    if args.run:
+        request('run ' + args.run)
+        sys.exit()
+
+    # Pick up the schedule where it was left. Jobs that were due while the
+    # scheduler was not running are run once, as soon as it starts.
+    state = load_state(STATE)
+    now = time.time()
+    for name, job in jobs.items():
+        saved = state.get(name, {})
+        for key in ('last_start', 'last_end', 'last_status', 'runs',
+                    'coalesced'):
+            if key in saved:
+                job[key] = saved[key]
+        schedule(job, saved.get('due') or now)
+
+    # Create the log directory once, rather than in every job.
+    if not os.path.isdir(LOG_DIRECTORY):
+        os.makedirs(LOG_DIRECTORY)
+
+    scheduler = Scheduler(jobs)
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    server = serve(scheduler)
+    try:
+        scheduler.loop()
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(SOCKET)
+        save_state(STATE, jobs)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,22 +26,54 @@
 # https://www.tarsnap.com/
 #
 ###############################################################################
+import array
+import atexit
 import datetime
+import hashlib
+import itertools
+import json
 import os
+import random
+import re
+import resource
+import stat
+import time
 import subprocess
 import sys
+import tempfile
+import threading
 import ConfigParser
+import Queue
 import argparse
+# The thread pools are only needed by some runs, and multiprocessing is slow
+# to import, so the functions that use them import it.
+
+# os.scandir is much faster than listing a directory and then calling lstat on
+# every entry. It is built in from Python 3.5, and available for older versions
+# from the scandir package. Fall back to os.listdir if neither is available.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # Set the location of the config file. This file is optional. If used, it
 # will overwrite the options below. The file should be in the INI-style format
 # parsable by the ConfigParser module. If the specified file does not exist,
 # Tarsnapper will simply continue. Note that the os module is available.
+# Each configuration file may use its own Tarsnap account, so the caches below
+# are kept apart for every configuration file other than this one, unless the
+# file gives their paths itself. The name of the file is added to each path.
 CONFIG = os.path.expanduser('~/.tarsnapper.conf')
 
 # Set the location of the Tarsnap binary.
 TARSNAP = '/usr/local/bin/tarsnap'
 
+# Set the location of the ionice binary.
+IONICE = '/usr/bin/ionice'
+
 # Specify a dictionary of archives. The key should be the base name of the
 # archive. The value should be a string of the files or directories that the
 # archive should contain. Multiple files or directories may be contained within
@@ -60,6 +92,18 @@ SUFFIX = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
 # empty. See the convert_to_timedelta docstring for appropriate format.
 MAXIMUM_AGE = '4w'
 
+# Instead of a maximum age, archives may be pruned with a grandfather-father-son
+# retention policy. For each archive in BACKUPS, the newest archive from each of
+# the most recent N hours, days, weeks, months and years is kept, and all of
+# the others are deleted. Set a period to 0 to keep nothing on its account. If
+# any period is set, MAXIMUM_AGE is ignored. Archives whose names do not start
+# with one of the names in BACKUPS are never deleted by the policy.
+KEEP_HOURLY = 0
+KEEP_DAILY = 0
+KEEP_WEEKLY = 0
+KEEP_MONTHLY = 0
+KEEP_YEARLY = 0
+
 # Tarsnap will begin the archival process before it checks permissions on
 # the files or directories specified. Even if it has no access, it will
 # still create the archive and result in a few bytes being transferred before
@@ -70,6 +114,28 @@ MAXIMUM_AGE = '4w'
 # not check _inside_ any of the given directories.
 PERMISSION_CHECK = True
 
+# The following option, if enabled, extends the permission check to walk every
+# directory inside the given files and directories, and to check that each
+# file and directory within them can be read. The walk is split across
+# SCAN_JOBS threads. To keep later runs fast, the modification time of each
+# directory is cached in SCAN_CACHE, and a directory that has not changed is
+# not listed or checked again. Note that changing the permissions of a file
+# does not change the modification time of its directory, so such a change
+# will not be noticed until something else in the directory changes. Set
+# SCAN_CACHE to an empty string to always walk everything.
+DEEP_PERMISSION_CHECK = False
+SCAN_JOBS = 4
+SCAN_CACHE = os.path.expanduser('~/.cache/tarsnapper/scan')
+
+# Every run normally creates a new archive for every entry in BACKUPS, even if
+# nothing within it has changed. The following option, if enabled, fingerprints
+# the path, size, mode and modification time of everything in each archive,
+# using SCAN_JOBS threads, and skips the archive if nothing has changed since
+# the last time it was created. Fingerprints are stored in FINGERPRINTS. The
+# most recent archive of an unchanged entry is never deleted, however old.
+SKIP_UNCHANGED = False
+FINGERPRINTS = os.path.expanduser('~/.cache/tarsnapper/fingerprints')
+
 # Specify a Tarsnap key-file to be used when deleting archives. This is useful
 # if you have a read/write key specified in your tarsnap.conf file as the
 # default key to be used when creating archives, but you have a separate
@@ -77,6 +143,79 @@ PERMISSION_CHECK = True
 #DELETE_KEY = os.path.expanduser('~/.tarsnap.del.key')
 DELETE_KEY = ''
 
+# Specify the number of archives that may be created at the same time. Each
+# archive is still created by its own tarsnap process, but up to this many of
+# those processes will be run in parallel. A failure in one archive will not
+# stop the others from being created.
+JOBS = 1
+
+# Tarsnapper keeps a local index of archives so that it does not have to ask
+# Tarsnap for the full archive listing every time it looks for old archives.
+# The index is updated whenever Tarsnapper creates or deletes an archive, and
+# is rebuilt from Tarsnap's listing when it is older than INDEX_MAX_AGE, after
+# a deletion fails, or when the --sync option is given. Archives created or
+# deleted by other machines are only noticed when the index is rebuilt. Set
+# INDEX to an empty string to always ask Tarsnap. See the convert_to_timedelta
+# docstring for the format of INDEX_MAX_AGE.
+INDEX = os.path.expanduser('~/.cache/tarsnapper/index')
+INDEX_MAX_AGE = '1d'
+
+# Old archives are deleted in batches of this many archives per tarsnap
+# command, so that a large backlog of old archives does not build a single
+# enormous command line. Each batch is removed from the local index as soon as
+# it has been deleted, so if a run is interrupted the next run will only try
+# to delete the archives that remain. Up to DELETE_JOBS batches may be deleted
+# at the same time.
+DELETE_BATCH_SIZE = 100
+DELETE_JOBS = 1
+
+# Tarsnapper can record how long each tarsnap command takes, how much CPU time
+# it uses and how much output it produces, or for a new archive, how much new
+# data it uploads. Each command is appended to METRICS_FILE as a line of JSON,
+# and a summary of the run is written to PROMETHEUS_FILE for the Prometheus
+# node exporter's textfile collector. Leave either empty to disable it. CPU
+# time is measured across all child processes, so it is only approximate when
+# archives are created in parallel.
+METRICS_FILE = ''
+PROMETHEUS_FILE = ''
+
+# Archives may be checked with --verify N, which lists the contents of N
+# archives with tarsnap -t, using JOBS tarsnap processes at once. Archives never
+# change once created, so each archive that is listed successfully is recorded
+# in VERIFIED, and archives which have not been checked yet are chosen first.
+# Set VERIFIED to an empty string to choose archives at random every time.
+VERIFIED = os.path.expanduser('~/.cache/tarsnapper/verified')
+
+# Limit the rate that archives are uploaded at during the given times of day.
+# This is a comma separated list of periods and rates in bytes per second, such
+# as '08:00-18:00 500K, 18:00-22:00 2M', which is passed to tarsnap as
+# --maxbw-rate-up. A period may cross midnight. Outside of every period, and
+# with a rate of 0, there is no limit. When archives are created in parallel,
+# the rate is shared between the JOBS tarsnap processes. Leave empty to disable
+# it.
+THROTTLE = ''
+
+# Lower the CPU priority (from 1 to 19) and the I/O scheduling class (1 for
+# realtime, 2 for best-effort and 3 for idle) and level (from 0 to 7) of
+# Tarsnapper and every tarsnap process it runs. Set to 0 to leave them
+# unchanged.
+NICE = 0
+IONICE_CLASS = 0
+IONICE_LEVEL = 0
+
+# Tarsnap can report its progress while it creates an archive. If
+# PROGRESS_BYTES is set, a line is printed each time an archive has processed
+# that many more bytes, giving the rate and an estimate of the time left. The
+# estimate is based on the size that the archive reached last time, which is
+# recorded in PROGRESS_SIZES. Set PROGRESS_BYTES to 0 to disable it.
+PROGRESS_BYTES = 0
+PROGRESS_SIZES = os.path.expanduser('~/.cache/tarsnapper/sizes')
+
+# Give up on any tarsnap command that runs for longer than this. See the
+# convert_to_timedelta docstring for the format. Leave empty to wait for as
+# long as each command takes.
+TIMEOUT = ''
+
 # End configuration here.
 ###############################################################################
 
@@ -128,24 +267,498 @@ def convert_to_timedelta(time_val):
         return datetime.timedelta(weeks=num)
 
 
-def execute(binary, arguments):
+def record_metric(stage, label, start, usage, bytes_out, error=None):
     """
-    Execute a binary with the given arguments. Complain and exit if any errors
-    are raised.
+    Record the wall time, child CPU time and output size of a finished
+    command, given the time and child resource usage from when it started.
+    """
+    end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    METRICS.append({
+        'time': start,
+        'stage': stage,
+        'label': label,
+        'seconds': time.time() - start,
+        'cpu_user_seconds': end.ru_utime - usage.ru_utime,
+        'cpu_system_seconds': end.ru_stime - usage.ru_stime,
+        'bytes_out': bytes_out,
+        'error': error,
+    })
+
+
+def write_metrics():
+    """
+    Append the recorded metrics to METRICS_FILE as lines of JSON, and write a
+    summary of them to PROMETHEUS_FILE.
+    """
+    if METRICS_FILE and METRICS:
+        f = open(METRICS_FILE, 'a')
+        for metric in METRICS:
+            f.write(json.dumps(metric, sort_keys=True) + '\n')
+        f.close()
+    if PROMETHEUS_FILE:
+        # Sum the metrics for each stage and label.
+        totals = {}
+        for metric in METRICS:
+            key = (metric['stage'], metric['label'] or '')
+            total = totals.setdefault(key, [0, 0, 0, 0])
+            total[0] += metric['seconds']
+            total[1] += (metric['cpu_user_seconds'] +
+                         metric['cpu_system_seconds'])
+            total[2] += metric['bytes_out']
+            if metric['error']:
+                total[3] += 1
+        lines = []
+        for i, (name, description) in enumerate((
+                ('seconds', 'Wall time spent in tarsnap commands.'),
+                ('cpu_seconds', 'CPU time used by tarsnap commands.'),
+                ('output_bytes', 'New data uploaded by create commands, '
+                 'or output produced by other commands.'),
+                ('failures', 'Number of failed tarsnap commands.'))):
+            name = 'tarsnapper_command_' + name
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s gauge' % name)
+            for (stage, label), total in sorted(totals.items()):
+                label = label.replace('\\', '\\\\').replace('"', '\\"')
+                lines.append('%s{stage="%s",archive="%s"} %s' %
+                             (name, stage, label, total[i]))
+        lines.append('# HELP tarsnapper_last_run_timestamp_seconds Time that '
+                     'tarsnapper last finished.')
+        lines.append('# TYPE tarsnapper_last_run_timestamp_seconds gauge')
+        lines.append('tarsnapper_last_run_timestamp_seconds %f' % time.time())
+        # The textfile collector may read the file at any time, so write it
+        # atomically.
+        temporary = PROMETHEUS_FILE + '.tmp'
+        f = open(temporary, 'w')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+        os.rename(temporary, PROMETHEUS_FILE)
+
+
+class ExecuteError(Exception):
+    """Raised by execute when errors should not cause an exit."""
+    pass
+
+
+# Match the progress messages that tarsnap writes with --progress-bytes, which
+# give the number of bytes processed so far, with or without a unit.
+PROGRESS_PATTERN = re.compile(r'([0-9.]+) ?([kKMGTPE]?B|bytes)\b')
+UNITS = {'B': 1, 'bytes': 1, 'kB': 1e3, 'KB': 1e3, 'MB': 1e6, 'GB': 1e9,
+         'TB': 1e12, 'PB': 1e15, 'EB': 1e18}
+
+
+def parse_progress(line):
+    """
+    Return the number of bytes processed that a tarsnap progress message
+    gives, or None if the line is not a progress message.
+    """
+    if 'Processed' not in line:
+        return None
+    match = PROGRESS_PATTERN.search(line)
+    if not match:
+        return None
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+# Match the lines of the statistics that tarsnap writes with --print-stats.
+STATS_PATTERN = re.compile(r'^\s*(Total size|All archives|\(unique data\)|'
+                           r'This archive|New data)')
+
+
+def parse_stats(line):
+    """
+    Return the compressed size of the new data that a line of tarsnap's
+    statistics gives, 0 for any other line of the statistics, or None if the
+    line is not part of the statistics.
+    """
+    match = STATS_PATTERN.match(line)
+    if not match:
+        return None
+    if match.group(1) != 'New data':
+        return 0
+    # The sizes are humanized if tarsnap is run with --humanize-numbers.
+    sizes = PROGRESS_PATTERN.findall(line)
+    if sizes:
+        number, unit = sizes[-1]
+        return int(float(number) * UNITS[unit])
+    return int(line.split()[-1])
+
+
+def format_size(size):
+    """Return a size in bytes as a short string, such as '1.5 GB'."""
+    for unit in ('B', 'kB', 'MB', 'GB', 'TB'):
+        if size < 1000 or unit == 'TB':
+            break
+        size /= 1000.0
+    if unit == 'B':
+        return '%d B' % size
+    return '%.1f %s' % (size, unit)
+
+
+class Progress(object):
+    """
+    Print the progress of an archive as tarsnap reports it, with the rate and,
+    if the expected size is known, an estimate of the time left.
+    """
+
+    def __init__(self, archive, expected=None):
+        self.archive = archive
+        self.expected = expected
+        self.processed = 0
+        self.start = time.time()
+
+    def __call__(self, processed):
+        self.processed = processed
+        rate = processed / max(time.time() - self.start, 0.001)
+        message = 'Archive %s: %s processed, %s/s' % (
+            self.archive, format_size(processed), format_size(rate))
+        if self.expected and self.expected > processed and rate:
+            message += ', about %d seconds left' % (
+                (self.expected - processed) / rate)
+        # A single write keeps the lines of archives created at the same time
+        # from being interleaved.
+        sys.stdout.write(message + '\n')
+        sys.stdout.flush()
+
+
+def read_lines(arguments, timeout=None, progress=None, stats=None):
+    """
+    Run a command, yielding lists of the lines of its output as they are
+    written, so that the whole output is never held in memory. Output is read
+    whenever it is ready, up to 64 kB at a time, which is much faster than
+    reading a line at a time. If a progress function is given,
+    the progress messages on standard error are passed to it as the number of
+    bytes processed. If a stats list is given, the size of the new data in
+    tarsnap's statistics is appended to it and the statistics are not shown.
+    Anything else on standard error is passed through.
+    The command is killed if it runs for longer than the timeout, in seconds.
+    Raise an ExecuteError if the command cannot be run, times out or returns a
+    non-zero status.
     """
-    arguments.insert(0, binary)
     try:
-        process = subprocess.check_output(arguments)
+        process = subprocess.Popen(
+            arguments, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE if progress or stats is not None
+            else None)
     except OSError:
-        print 'Could not find %s' % binary
-        sys.exit(2)
-    except subprocess.CalledProcessError:
-        print '%s returned non-zero status' % (binary)
+        raise ExecuteError('Could not find %s' % arguments[0])
+    timed_out = []
+
+    def kill():
+        """Kill the command, unless it has already finished."""
+        try:
+            process.kill()
+        except OSError:
+            pass
+
+    def expire():
+        """Kill the command when it has run for too long."""
+        timed_out.append(True)
+        kill()
+
+    def read_errors():
+        """Read standard error, picking out progress and statistics."""
+        for line in iter(process.stderr.readline, ''):
+            if progress:
+                processed = parse_progress(line)
+                if processed is not None:
+                    progress(processed)
+                    continue
+            if stats is not None:
+                size = parse_stats(line)
+                if size is not None:
+                    if size:
+                        stats.append(size)
+                    continue
+            sys.stderr.write(line)
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+    reader = None
+    if progress or stats is not None:
+        reader = threading.Thread(target=read_errors)
+        reader.daemon = True
+        reader.start()
+    finished = False
+    try:
+        # A partial line is kept until the rest of it has been read.
+        pending = ''
+        while True:
+            data = os.read(process.stdout.fileno(), 65536)
+            if not data:
+                break
+            lines = (pending + data).split('\n')
+            pending = lines.pop()
+            if lines:
+                yield [line + '\n' for line in lines]
+        if pending:
+            yield [pending]
+        finished = True
+    finally:
+        # Do not leave the command running if the caller stops reading early.
+        if not finished:
+            kill()
+        process.stdout.close()
+        process.wait()
+        if reader:
+            reader.join()
+        if timer:
+            timer.cancel()
+            timer.join()
+    if timed_out:
+        raise ExecuteError('%s timed out after %s' % (arguments[0], TIMEOUT))
+    if process.returncode:
+        raise ExecuteError('%s returned non-zero status' % arguments[0])
+
+
+def execute(binary, arguments, exit_on_error=True, stage=None, label=None,
+            handle_lines=None, progress=None, stats=False):
+    """
+    Execute a binary with the given arguments, and return its output. Complain
+    and exit if any errors are raised. If exit_on_error is False, raise an
+    ExecuteError instead of exiting so that the caller may decide what to do.
+    If a stage is given, the command is timed and recorded under the stage and
+    label. If handle_lines is given, the output is passed to it as lists of
+    lines as it is read, instead of being kept and returned. If a progress
+    function is given, it is passed tarsnap's progress messages. If stats is
+    True, the size of the new data in tarsnap's --print-stats statistics is
+    recorded as the output of the command, rather than the size of what it
+    wrote to standard output. Every command is killed after TIMEOUT.
+    """
+    arguments.insert(0, binary)
+    start = time.time()
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    timeout = None
+    if TIMEOUT:
+        timeout = convert_to_timedelta(TIMEOUT).total_seconds()
+    output = []
+    size = 0
+    new_data = None
+    if stats:
+        new_data = []
+    try:
+        for lines in read_lines(arguments, timeout, progress, new_data):
+            size += sum(map(len, lines))
+            if handle_lines:
+                handle_lines(lines)
+            else:
+                output.extend(lines)
+    except ExecuteError as error:
+        error = str(error)
+    else:
+        if stats:
+            size = sum(new_data)
+        if stage:
+            record_metric(stage, label, start, usage, size)
+        return ''.join(output)
+
+    if stage:
+        record_metric(stage, label, start, usage, size, error)
+
+    if exit_on_error:
+        print error
         sys.exit(2)
+    raise ExecuteError(error)
+
+
+def list_directory(path):
+    """
+    Return a list of (path, kind) tuples for the entries of a directory, where
+    kind is 'directory', 'file' or 'other'. Symbolic links are 'other', as
+    tarsnap does not follow them by default.
+    """
+    entries = []
+    if scandir:
+        for entry in scandir(path):
+            if entry.is_symlink():
+                kind = 'other'
+            elif entry.is_dir():
+                kind = 'directory'
+            elif entry.is_file():
+                kind = 'file'
+            else:
+                kind = 'other'
+            entries.append((entry.path, kind))
     else:
-        return process
+        for name in os.listdir(path):
+            entry = os.path.join(path, name)
+            mode = os.lstat(entry).st_mode
+            if stat.S_ISDIR(mode):
+                kind = 'directory'
+            elif stat.S_ISREG(mode):
+                kind = 'file'
+            else:
+                kind = 'other'
+            entries.append((entry, kind))
+    return entries
 
-    return False
+
+def parallel_walk(paths, visit, jobs):
+    """
+    Call visit on each of the given paths from a pool of threads. visit should
+    return a list of further paths, such as the subdirectories of a directory,
+    which are visited in turn. Return a list of the paths for which visit
+    raised an OSError. Any other exception is raised once the walk is over.
+    """
+    queue = Queue.Queue()
+    errors = []
+    failures = []
+
+    def worker():
+        """Visit paths from the queue until given None."""
+        while True:
+            path = queue.get()
+            if path is None:
+                return
+            try:
+                for next_path in visit(path):
+                    queue.put(next_path)
+            except OSError:
+                errors.append(path)
+            except Exception:
+                # Keep the worker running, so that the walk still finishes.
+                failures.append(sys.exc_info())
+            finally:
+                queue.task_done()
+
+    for path in paths:
+        queue.put(path)
+    threads = []
+    for i in range(max(1, jobs)):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    # Once every path has been visited, stop the workers.
+    queue.join()
+    for thread in threads:
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise failures[0][0], failures[0][1], failures[0][2]
+    return errors
+
+
+def scan_tree(paths, cache, jobs):
+    """
+    Walk the given paths with a pool of threads, looking for files and
+    directories that cannot be read. The cache maps each directory to its
+    modification time, the unreadable files within it and its subdirectories,
+    as returned by the previous scan. Directories that have not changed since
+    then are not listed again. Return a list of unreadable paths and the new
+    cache.
+    """
+    lock = threading.Lock()
+    unreadable = []
+    new_cache = {}
+
+    def scan(path):
+        """Check a single path, returning any subdirectories."""
+        st = os.lstat(path)
+        if not stat.S_ISDIR(st.st_mode):
+            if stat.S_ISREG(st.st_mode) and not os.access(path, os.R_OK):
+                unreadable.append(path)
+            return []
+        if not os.access(path, os.R_OK | os.X_OK):
+            unreadable.append(path)
+            return []
+        cached = cache.get(path)
+        if cached and cached[0] == st.st_mtime:
+            # Files that were unreadable last time are checked again, in case
+            # their permissions have since been fixed.
+            files = [entry for entry in cached[1]
+                     if not os.access(entry, os.R_OK)]
+            subdirectories = cached[2]
+        else:
+            files = []
+            subdirectories = []
+            for entry, kind in list_directory(path):
+                if kind == 'directory':
+                    subdirectories.append(entry)
+                elif kind == 'file' and not os.access(entry, os.R_OK):
+                    files.append(entry)
+        lock.acquire()
+        try:
+            new_cache[path] = [st.st_mtime, files, subdirectories]
+            unreadable.extend(files)
+        finally:
+            lock.release()
+        return subdirectories
+
+    paths = [os.path.abspath(path) for path in paths]
+    unreadable.extend(parallel_walk(paths, scan, jobs))
+    return sorted(unreadable), new_cache
+
+
+def fingerprint_tree(paths, jobs):
+    """
+    Walk the given paths with a pool of threads, and return a fingerprint of
+    the path, size, mode and modification time of everything within them, or
+    None if any part of them could not be read.
+    """
+    records = []
+
+    def record(path):
+        """Record a single path, returning it if it is a directory."""
+        st = os.lstat(path)
+        records.append('%s\0%d\0%o\0%r' % (path, st.st_size, st.st_mode,
+                                            st.st_mtime))
+        if stat.S_ISDIR(st.st_mode):
+            return [path]
+        return []
+
+    def visit(path):
+        """Record the entries of a directory, returning its subdirectories."""
+        subdirectories = []
+        for entry, kind in list_directory(path):
+            subdirectories.extend(record(entry))
+        return subdirectories
+
+    try:
+        directories = []
+        for path in paths:
+            directories.extend(record(os.path.abspath(path)))
+    except OSError:
+        return None
+    if parallel_walk(directories, visit, jobs):
+        return None
+    digest = hashlib.sha1()
+    for entry in sorted(records):
+        digest.update(entry + '\n')
+    return digest.hexdigest()
+
+
+def load_cache(path):
+    """Return the contents of a JSON cache file, or an empty dictionary."""
+    if not path:
+        return {}
+    try:
+        f = open(path, 'r')
+    except IOError:
+        return {}
+    try:
+        return json.load(f)
+    except ValueError:
+        return {}
+    finally:
+        f.close()
+
+
+def save_cache(path, cache):
+    """Save a dictionary to a JSON cache file."""
+    if not path:
+        return
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    temporary = path + '.tmp'
+    f = open(temporary, 'w')
+    json.dump(cache, f)
+    f.close()
+    os.rename(temporary, path)
 
 
 def prepare_archive(archive, contents):
@@ -161,6 +774,16 @@ def prepare_archive(archive, contents):
                 permissions = False
                 return False
 
+    # Check the permissions of everything inside the items, if requested.
+    if DEEP_PERMISSION_CHECK:
+        unreadable, cache = scan_tree(contents.strip().split(),
+                                      SCAN_RESULTS.get(archive, {}), SCAN_JOBS)
+        SCAN_RESULTS[archive] = cache
+        if unreadable:
+            print 'Archive %s cannot read:\n\t%s' % (archive,
+                                                    '\n\t'.join(unreadable))
+            return False
+
     # Build the archive name by adding the suffix to the base.
     if SUFFIX:
         archive_name = '%s.%s' % (archive, SUFFIX)
@@ -170,104 +793,770 @@ def prepare_archive(archive, contents):
     return archive_name
 
 
-def create_archive(archive_name, item):
-    """Create a new Tarsnap archive of an item, or items."""
-    arguments = ['-c', '-f', archive_name]
-    # If the archive is to include multiple files or directories, split them
-    # out so that they are sent as different items in the list.
-    arguments.extend(item.strip().split(' '))
-    return execute(TARSNAP, arguments)
+def parse_rate(rate):
+    """
+    Given a rate such as '500K', return the number of bytes it represents.
+    Accepts a plain number of bytes, or a number followed by K, M or G.
+    """
+    rate = rate.strip().upper()
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if rate[-1:] in multipliers:
+        return int(rate[:-1]) * multipliers[rate[-1]]
+    return int(rate)
+
+
+def current_rate(throttle, now=None):
+    """
+    Given a throttle such as '08:00-18:00 500K', return the rate in bytes per
+    second that applies at the given time, or 0 if there is no limit.
+    """
+    if not throttle:
+        return 0
+    now = now or datetime.datetime.now()
+    minute = now.hour * 60 + now.minute
+    for period in throttle.split(','):
+        hours, rate = period.split()
+        start, end = [int(clock[:2]) * 60 + int(clock[3:])
+                      for clock in hours.split('-')]
+        if start <= end:
+            active = start <= minute < end
+        else:
+            active = minute >= start or minute < end
+        if active:
+            return parse_rate(rate)
+    return 0
+
+
+def lower_priority():
+    """
+    Lower the CPU and I/O priority of Tarsnapper, which every tarsnap process
+    it runs inherits.
+    """
+    if NICE:
+        os.nice(NICE)
+    if IONICE_CLASS:
+        arguments = ['-c', str(IONICE_CLASS)]
+        if IONICE_CLASS in (1, 2):
+            arguments.extend(['-n', str(IONICE_LEVEL)])
+        execute(IONICE, arguments + ['-p', str(os.getpid())])
+
+
+def create_archive(archive_name, items, exit_on_error=True, label=None,
+                   progress=None):
+    """
+    Create a new Tarsnap archive of a list of items, which are passed to
+    tarsnap as they are. If a progress function is given, tarsnap reports its
+    progress to it every PROGRESS_BYTES bytes.
+    """
+    # Ask for the statistics, to record how much new data was uploaded.
+    arguments = ['-c', '--print-stats', '-f', archive_name]
+    if progress:
+        arguments.extend(['--progress-bytes', str(PROGRESS_BYTES)])
+    # Share the upload limit between the archives being created at once.
+    rate = current_rate(THROTTLE)
+    if rate:
+        arguments.extend(['--maxbw-rate-up', str(max(1, rate // JOBS))])
+    arguments.extend(items)
+    return execute(TARSNAP, arguments, exit_on_error, 'create', label,
+                   progress=progress, stats=True)
+
+
+def run_archive(job):
+    """
+    Prepare and create a single archive from an (archive, contents) tuple.
+    Return a tuple of the archive, the archive name, any error and the number
+    of seconds taken to create it, so that the result may be collected from a
+    worker thread.
+    """
+    archive, contents = job
+    archive_name = prepare_archive(archive, contents)
+    if not archive_name:
+        return (archive, None, None, 0)
+    progress = None
+    if PROGRESS_BYTES:
+        progress = Progress(archive, PROGRESS_RESULTS.get(archive))
+    start = time.time()
+    try:
+        # If the archive is to include multiple files or directories, split
+        # them out so that they are sent as different items in the list.
+        create_archive(archive_name, contents.strip().split(' '),
+                       exit_on_error=False, label=archive, progress=progress)
+    except ExecuteError as error:
+        return (archive, archive_name, str(error), time.time() - start)
+    if progress and progress.processed:
+        PROGRESS_RESULTS[archive] = progress.processed
+    return (archive, archive_name, None, time.time() - start)
+
+
+def create_archives(backups, jobs):
+    """
+    Create all of the given archives, running up to the given number of jobs
+    at once. Return a list of (archive, archive name, error, seconds) tuples.
+    """
+    from multiprocessing.pool import ThreadPool
+    jobs = max(1, min(jobs, len(backups)))
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.map(run_archive, sorted(backups.items()))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def verify_archive(archive_name):
+    """
+    List the contents of an archive. Return a tuple of the archive name, the
+    number of entries, any error and the number of seconds taken, so that the
+    result may be collected from a worker thread.
+    """
+    start = time.time()
+    # Only count the entries, as the listing of a large archive may not fit
+    # in memory.
+    entries = [0]
+
+    def count(lines):
+        """Count the entries of part of the listing."""
+        entries[0] += len(lines)
+
+    try:
+        execute(TARSNAP, ['-t', '-f', archive_name], exit_on_error=False,
+                stage='verify', label=archive_name, handle_lines=count)
+    except ExecuteError as error:
+        return (archive_name, 0, str(error), time.time() - start)
+    return (archive_name, entries[0], None, time.time() - start)
 
 
-def delete_archives(archive_list):
+def sample_archives(archives, verified, count):
+    """
+    Choose up to count archives to verify, picking at random from those that
+    have never been verified, and then from those verified longest ago.
+    """
+    unverified = [name for name in archives if name not in verified]
+    random.shuffle(unverified)
+    oldest = sorted([name for name in archives if name in verified],
+                    key=lambda name: verified[name])
+    return (unverified + oldest)[:count]
+
+
+def verify_archives(archive_list, jobs):
+    """
+    Verify the given archives, running up to the given number of jobs at
+    once. Return a list of (archive name, entries, error, seconds) tuples.
+    """
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, min(jobs, len(archive_list))))
+    try:
+        results = pool.map(verify_archive, archive_list)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def delete_archives(archive_list, exit_on_error=True):
     """Delete a list of tarsnap archives."""
     args = ['--no-print-stats', '-d']
     if DELETE_KEY:
         args.extend(['--keyfile', DELETE_KEY])
     for archive in archive_list:
         args.extend(['-f', archive])
-    return execute(TARSNAP, args)
+    return execute(TARSNAP, args, exit_on_error, 'delete')
+
+
+def delete_batch(batch):
+    """
+    Delete a batch of archives. Return a tuple of the batch and any error, so
+    that the result may be collected from a worker thread.
+    """
+    try:
+        delete_archives(batch, exit_on_error=False)
+    except ExecuteError as error:
+        return (batch, str(error))
+    return (batch, None)
+
+
+def delete_archives_in_batches(archive_list, batch_size, jobs):
+    """
+    Delete a list of tarsnap archives in batches of the given size, running up
+    to the given number of batches at once. The local index is updated as each
+    batch completes, and invalidated if any batch fails, as tarsnap may have
+    deleted some of a failed batch. Return a list of (batch, error) tuples for
+    any batches that could not be deleted.
+    """
+    from multiprocessing.pool import ThreadPool
+    batch_size = max(1, batch_size)
+    batches = [archive_list[i:i + batch_size]
+               for i in range(0, len(archive_list), batch_size)]
+    failed = []
+    pool = ThreadPool(max(1, min(jobs, len(batches))))
+    try:
+        for batch, error in pool.imap_unordered(delete_batch, batches):
+            if error:
+                failed.append((batch, error))
+            else:
+                update_index(deleted=batch)
+    finally:
+        pool.close()
+        pool.join()
+    if failed:
+        invalidate_index()
+    return failed
 
 
 def list_archives():
     """Return a list of available Tarsnap archives."""
-    archives = execute(TARSNAP, ['--list-archives', '-v'])
+    archives = []
+
+    def add(lines):
+        """Add the archives from part of the listing."""
+        archives.extend([line.rstrip('\n') for line in lines if line.strip()])
+
+    execute(TARSNAP, ['--list-archives', '-v'], stage='list',
+            handle_lines=add)
     if archives:
-        return archives.strip().split('\n')
+        return archives
 
     return False
 
-# Set available command-line arguments.
-parser = argparse.ArgumentParser(description='A Python script to manage \
-                                              Tarsnap archives.')
-parser.add_argument('-c', '--config', action='store', dest='config',
-                    help='Specify the configuration file to use.')
-parser.add_argument('-a', '--archive', action='store', dest='archive',
-                    help='Specify a named archive to execute.')
-parser.add_argument('-r', '--remove', action='store_const', const=True,
-                    help='Remove archives old archives and exit.')
-# Parse command-line arguments.
-args = parser.parse_args()
-
-# Read the user's configuration file.
-config = ConfigParser.RawConfigParser()
-if args.config:
-    CONFIG = args.config
-config.read(CONFIG)
-# Get any settings defined in the config file.
-if config.has_section('Settings'):
-    if config.has_option('Settings', 'tarsnap'):
-        TARSNAP = config.get('Settings', 'tarsnap')
-    if config.has_option('Settings', 'maximum_age'):
-        MAXIMUM_AGE = config.get('Settings', 'maximum_age')
-    if config.has_option('Settings', 'permission_check'):
-        PERMISSION_CHECK = config.getboolean('Settings', 'permission_check')
-    if config.has_option('Settings', 'suffix'):
-        if config.getboolean('Settings', 'suffix') is False:
-            SUFFIX = False
-    if config.has_option('Settings', 'delete_key'):
-        DELETE_KEY = config.get('Settings', 'delete_key')
-# Get any archives defined in the config file.
-if config.has_section('Archives'):
-    BACKUPS = {}
-    for name in config.options('Archives'):
-        BACKUPS[name] = config.get('Archives', name)
-
-# If the user did not request deletion only, perform the backups.
-if not args.remove:
-    # If the user specified a single archive, only execute that one.
-    if args.archive:
-        try:
-            archive_name = prepare_archive(args.archive, BACKUPS[args.archive])
-        except KeyError:
-            print 'Archive %s is not configured.' % args.archive
+
+def read_index():
+    """
+    Return the list of archives in the local index, in the same format as
+    list_archives, or None if the index does not exist or is too old.
+    """
+    try:
+        f = open(INDEX, 'r')
+    except IOError:
+        return None
+    try:
+        # The first line records when the index was last synced with Tarsnap.
+        header = f.readline().strip().split('\t')
+        if header[0] != '#synced' or len(header) != 2:
+            return None
+        synced = datetime.datetime.fromtimestamp(float(header[1]))
+        if datetime.datetime.now() - synced > \
+                convert_to_timedelta(INDEX_MAX_AGE):
+            return None
+        return [line.rstrip('\n') for line in f if line.strip()]
+    finally:
+        f.close()
+
+
+def write_index(archives, synced):
+    """
+    Write the list of archives to the local index, recording the time (in
+    seconds since the epoch) that it was last synced with Tarsnap.
+    """
+    directory = os.path.dirname(INDEX)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Write to a temporary file first, so that an interrupted write cannot
+    # leave a truncated index behind. Each writer has its own temporary file,
+    # so that writers do not clobber each other.
+    descriptor, temporary = tempfile.mkstemp(dir=directory or '.',
+                                             prefix='.index')
+    f = os.fdopen(descriptor, 'w')
+    f.write('#synced\t%f\n' % synced)
+    for archive in archives:
+        f.write(archive + '\n')
+    f.close()
+    os.rename(temporary, INDEX)
+
+
+def invalidate_index():
+    """Remove the local index, so that it is rebuilt from Tarsnap next time."""
+    if not INDEX:
+        return
+    try:
+        os.remove(INDEX)
+    except OSError:
+        pass
+
+
+def index_synced():
+    """Return the time that the local index was last synced with Tarsnap."""
+    f = open(INDEX, 'r')
+    try:
+        return float(f.readline().strip().split('\t')[1])
+    finally:
+        f.close()
+
+
+def update_index(created=(), deleted=()):
+    """
+    Add newly created archives to, and remove deleted archives from, the local
+    index. Does nothing if there is no current index to update.
+    """
+    if not INDEX:
+        return
+    archives = read_index()
+    if archives is None:
+        return
+    now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    deleted = set(deleted)
+    archives = [archive for archive in archives
+                if archive.partition('\t')[0] not in deleted]
+    archives.extend(['%s\t%s' % (name, now) for name in created])
+    write_index(archives, index_synced())
+
+
+def load_archives(sync=False):
+    """
+    Return a list of available Tarsnap archives, from the local index if it is
+    current, or from Tarsnap (rebuilding the index) if it is not or if a sync
+    was requested.
+    """
+    if INDEX and not sync:
+        archives = read_index()
+        if archives is not None:
+            return archives
+    synced = time.time()
+    archives = list_archives()
+    if INDEX:
+        write_index(archives or [], synced)
+    return archives
+
+
+# The ordinal of the day that listing dates are counted from.
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+
+def parse_listing(archives):
+    """
+    Parse a list of archives, in the format returned by list_archives, into a
+    list of names and an array of dates. Each date is a number of seconds
+    since the epoch, counted in local time as Tarsnap lists it. The fields of
+    every '%Y-%m-%d %H:%M:%S' date are at fixed offsets, so they are sliced out
+    rather than parsed with strptime, and each day is only converted once.
+    """
+    names = []
+    dates = array.array('l')
+    days = {}
+    for archive in archives:
+        name, _, date = archive.strip().partition('\t')
+        if len(date) != 19:
+            raise ValueError('Archive %s has an invalid date: %s' % (name,
+                                                                     date))
+        day = date[:10]
+        seconds = days.get(day)
+        if seconds is None:
+            seconds = days[day] = (datetime.date(
+                int(day[:4]), int(day[5:7]), int(day[8:10])).toordinal() -
+                EPOCH) * 86400
+        names.append(name)
+        dates.append(seconds + int(date[11:13]) * 3600 +
+                     int(date[14:16]) * 60 + int(date[17:19]))
+    return names, dates
+
+
+def day_date(seconds):
+    """Return the date of a number of seconds returned by parse_listing."""
+    return datetime.date.fromordinal(seconds // 86400 + EPOCH)
+
+# Define the retention periods, from shortest to longest, along with a function
+# that returns the period a date returned by parse_listing falls within. Day
+# ordinals start on a Monday, so whole weeks of them are ISO weeks.
+RETENTION_PERIODS = (
+    ('hourly', lambda seconds: seconds // 3600),
+    ('daily', lambda seconds: seconds // 86400),
+    ('weekly', lambda seconds: (seconds // 86400 + EPOCH - 1) // 7),
+    ('monthly', lambda seconds: day_date(seconds).replace(day=1)),
+    ('yearly', lambda seconds: day_date(seconds).year),
+)
+
+
+def archive_base(name, bases):
+    """
+    Return the base name that an archive name was built from, or None if it
+    was not built from any of the given bases. The longest matching base is
+    used, so that the archives of 'site.logs' are not taken for those of
+    'site'.
+    """
+    if name in bases:
+        return name
+    parts = name.split('.')
+    for i in range(len(parts) - 1, 0, -1):
+        base = '.'.join(parts[:i])
+        if base in bases:
+            return base
+    return None
+
+
+def plan_by_age(archives, maximum_age):
+    """
+    Decide which archives to keep based on their age. Return a list of
+    (name, reasons) tuples, where reasons is empty for archives that should be
+    deleted.
+    """
+    now = datetime.datetime.now()
+    maximum_timedelta = convert_to_timedelta(maximum_age)
+    names, dates = parse_listing(archives)
+    # Any archive dated before the cutoff is older than the maximum allowed
+    # age, and is marked for deletion.
+    cutoff = ((now.toordinal() - EPOCH) * 86400 + now.hour * 3600 +
+              now.minute * 60 + now.second + now.microsecond / 1e6 -
+              maximum_timedelta.days * 86400 - maximum_timedelta.seconds)
+    return [(name, [] if date < cutoff else ['maximum age'])
+            for name, date in itertools.izip(names, dates)]
+
+
+def plan_by_retention(archives, bases, keep):
+    """
+    Decide which archives to keep under a grandfather-father-son retention
+    policy. The keep dictionary gives the number of each period in
+    RETENTION_PERIODS to keep for each of the base names. Return a list of
+    (name, reasons) tuples, where reasons lists the periods each archive is
+    kept for, and is empty for archives that should be deleted.
+    """
+    bases = set(bases)
+    plan = []
+    entries = []
+    # The archives of a base share everything before the last dot of their
+    # names, so the base of each such prefix is only looked up once.
+    prefixes = {}
+    names, dates = parse_listing(archives)
+    for name, date in itertools.izip(names, dates):
+        if name in bases:
+            base = name
+        else:
+            prefix = name.rpartition('.')[0]
+            base = prefixes.get(prefix, False)
+            if base is False:
+                base = prefixes[prefix] = archive_base(prefix, bases)
+        if base is None:
+            plan.append((name, ['unmanaged']))
+        else:
+            entries.append((base, date, name))
+
+    periods = [(period, function, keep[period])
+               for period, function in RETENTION_PERIODS if keep.get(period)]
+    # Sort by base name and then newest first, so that a single pass can keep
+    # the first archive seen in each period.
+    entries.sort(reverse=True)
+    current = None
+    for base, date, name in entries:
+        if base != current:
+            current = base
+            # For each period, track the last period seen and how many have
+            # been kept.
+            seen = dict((period, [None, 0]) for period, _, _ in periods)
+        reasons = []
+        for period, function, limit in periods:
+            state = seen[period]
+            if state[1] >= limit:
+                continue
+            key = function(date)
+            if key != state[0]:
+                state[0] = key
+                state[1] += 1
+                reasons.append(period)
+        plan.append((name, reasons))
+    return plan
+
+
+# Remember the default configuration file, whose caches keep the paths above.
+DEFAULT_CONFIG = CONFIG
+DEFAULT_CACHES = (SCAN_CACHE, FINGERPRINTS, INDEX, VERIFIED, PROGRESS_SIZES)
+
+# Hold the metrics recorded during this run.
+METRICS = []
+
+# Hold the results of the deep permission check, the fingerprints of the
+# archives and the sizes of the archives, by archive. main() loads them from
+# their caches, if they are enabled.
+SCAN_RESULTS = {}
+FINGERPRINT_RESULTS = {}
+PROGRESS_RESULTS = {}
+
+
+def config_cache(cache, path):
+    """
+    Return the path of a cache for the given configuration file, named after
+    the file and a hash of its full path, or an empty string if the cache is
+    disabled.
+    """
+    if not cache:
+        return cache
+    name = os.path.splitext(os.path.basename(path))[0].lstrip('.')
+    digest = hashlib.sha1(os.path.abspath(path)).hexdigest()[:8]
+    return '%s.%s-%s' % (cache, name, digest)
+
+
+def read_config(path):
+    """
+    Read the configuration file at the given path, if it exists, and use its
+    settings and archives in place of those above.
+    """
+    global TARSNAP, MAXIMUM_AGE, KEEP_HOURLY, KEEP_DAILY, KEEP_WEEKLY
+    global KEEP_MONTHLY, KEEP_YEARLY, PERMISSION_CHECK, DEEP_PERMISSION_CHECK
+    global SCAN_JOBS, SCAN_CACHE, SKIP_UNCHANGED, FINGERPRINTS, SUFFIX
+    global DELETE_KEY, JOBS, INDEX, INDEX_MAX_AGE, DELETE_BATCH_SIZE
+    global DELETE_JOBS, METRICS_FILE, PROMETHEUS_FILE, VERIFIED, THROTTLE, NICE
+    global IONICE_CLASS, IONICE_LEVEL, PROGRESS_BYTES, PROGRESS_SIZES, TIMEOUT
+    global BACKUPS
+    # Keep the caches of other configuration files apart from the default.
+    SCAN_CACHE, FINGERPRINTS, INDEX, VERIFIED, PROGRESS_SIZES = DEFAULT_CACHES
+    if os.path.abspath(path) != os.path.abspath(DEFAULT_CONFIG):
+        SCAN_CACHE, FINGERPRINTS, INDEX, VERIFIED, PROGRESS_SIZES = [
+            config_cache(cache, path) for cache in DEFAULT_CACHES]
+    config = ConfigParser.RawConfigParser()
+    config.read(path)
+    # Get any settings defined in the config file.
+    if config.has_section('Settings'):
+        if config.has_option('Settings', 'tarsnap'):
+            TARSNAP = config.get('Settings', 'tarsnap')
+        if config.has_option('Settings', 'maximum_age'):
+            MAXIMUM_AGE = config.get('Settings', 'maximum_age')
+        if config.has_option('Settings', 'keep_hourly'):
+            KEEP_HOURLY = config.getint('Settings', 'keep_hourly')
+        if config.has_option('Settings', 'keep_daily'):
+            KEEP_DAILY = config.getint('Settings', 'keep_daily')
+        if config.has_option('Settings', 'keep_weekly'):
+            KEEP_WEEKLY = config.getint('Settings', 'keep_weekly')
+        if config.has_option('Settings', 'keep_monthly'):
+            KEEP_MONTHLY = config.getint('Settings', 'keep_monthly')
+        if config.has_option('Settings', 'keep_yearly'):
+            KEEP_YEARLY = config.getint('Settings', 'keep_yearly')
+        if config.has_option('Settings', 'permission_check'):
+            PERMISSION_CHECK = config.getboolean('Settings',
+                                                 'permission_check')
+        if config.has_option('Settings', 'deep_permission_check'):
+            DEEP_PERMISSION_CHECK = config.getboolean('Settings',
+                                                      'deep_permission_check')
+        if config.has_option('Settings', 'scan_jobs'):
+            SCAN_JOBS = config.getint('Settings', 'scan_jobs')
+        if config.has_option('Settings', 'scan_cache'):
+            SCAN_CACHE = os.path.expanduser(config.get('Settings',
+                                                       'scan_cache'))
+        if config.has_option('Settings', 'skip_unchanged'):
+            SKIP_UNCHANGED = config.getboolean('Settings', 'skip_unchanged')
+        if config.has_option('Settings', 'fingerprints'):
+            FINGERPRINTS = os.path.expanduser(config.get('Settings',
+                                                         'fingerprints'))
+        if config.has_option('Settings', 'suffix'):
+            if config.getboolean('Settings', 'suffix') is False:
+                SUFFIX = False
+        if config.has_option('Settings', 'delete_key'):
+            DELETE_KEY = config.get('Settings', 'delete_key')
+        if config.has_option('Settings', 'jobs'):
+            JOBS = config.getint('Settings', 'jobs')
+        if config.has_option('Settings', 'index'):
+            INDEX = os.path.expanduser(config.get('Settings', 'index'))
+        if config.has_option('Settings', 'index_max_age'):
+            INDEX_MAX_AGE = config.get('Settings', 'index_max_age')
+        if config.has_option('Settings', 'delete_batch_size'):
+            DELETE_BATCH_SIZE = config.getint('Settings', 'delete_batch_size')
+        if config.has_option('Settings', 'delete_jobs'):
+            DELETE_JOBS = config.getint('Settings', 'delete_jobs')
+        if config.has_option('Settings', 'metrics_file'):
+            METRICS_FILE = os.path.expanduser(config.get('Settings',
+                                                         'metrics_file'))
+        if config.has_option('Settings', 'prometheus_file'):
+            PROMETHEUS_FILE = os.path.expanduser(config.get('Settings',
+                                                            'prometheus_file'))
+        if config.has_option('Settings', 'verified'):
+            VERIFIED = os.path.expanduser(config.get('Settings', 'verified'))
+        if config.has_option('Settings', 'throttle'):
+            THROTTLE = config.get('Settings', 'throttle')
+        if config.has_option('Settings', 'nice'):
+            NICE = config.getint('Settings', 'nice')
+        if config.has_option('Settings', 'ionice_class'):
+            IONICE_CLASS = config.getint('Settings', 'ionice_class')
+        if config.has_option('Settings', 'ionice_level'):
+            IONICE_LEVEL = config.getint('Settings', 'ionice_level')
+        if config.has_option('Settings', 'progress_bytes'):
+            PROGRESS_BYTES = config.getint('Settings', 'progress_bytes')
+        if config.has_option('Settings', 'progress_sizes'):
+            PROGRESS_SIZES = os.path.expanduser(config.get('Settings',
+                                                           'progress_sizes'))
+        if config.has_option('Settings', 'timeout'):
+            TIMEOUT = config.get('Settings', 'timeout')
+    # Get any archives defined in the config file.
+    if config.has_section('Archives'):
+        BACKUPS = {}
+        for name in config.options('Archives'):
+            BACKUPS[name] = config.get('Archives', name)
+
+
+def main():
+    """Create, verify and prune archives, as requested."""
+    global CONFIG, JOBS, SCAN_RESULTS, FINGERPRINT_RESULTS, PROGRESS_RESULTS
+    # Set available command-line arguments.
+    parser = argparse.ArgumentParser(description='A Python script to manage \
+                                                  Tarsnap archives.')
+    parser.add_argument('-c', '--config', action='store', dest='config',
+                        help='Specify the configuration file to use.')
+    parser.add_argument('-a', '--archive', action='store', dest='archive',
+                        help='Specify a named archive to execute.')
+    parser.add_argument('-r', '--remove', action='store_const', const=True,
+                        help='Remove archives old archives and exit.')
+    parser.add_argument('-n', '--dry-run', action='store_const', const=True,
+                        dest='dry_run',
+                        help='Print which old archives would be deleted, '
+                             'without creating or deleting any archives.')
+    parser.add_argument('-s', '--sync', action='store_const', const=True,
+                        help='Rebuild the local archive index from Tarsnap.')
+    parser.add_argument('-j', '--jobs', action='store', dest='jobs', type=int,
+                        help='Specify the number of archives to create at '
+                             'once.')
+    parser.add_argument('-v', '--verify', action='store', dest='verify',
+                        type=int, metavar='N',
+                        help='List the contents of N archives to check that '
+                             'they can be read, and exit.')
+    # Parse command-line arguments.
+    args = parser.parse_args()
+    # Read the user's configuration file.
+    if args.config:
+        CONFIG = args.config
+    read_config(CONFIG)
+    # Command-line options take precedence over the config file.
+    if args.jobs:
+        JOBS = args.jobs
+    # Lower the priority of the run, if requested.
+    lower_priority()
+    # Write out the metrics when the run ends, however it ends.
+    if METRICS_FILE or PROMETHEUS_FILE:
+        atexit.register(write_metrics)
+
+    # Check a sample of archives, if requested.
+    if args.verify:
+        names = [archive.partition('\t')[0]
+                 for archive in load_archives(args.sync) or []]
+        verified = load_cache(VERIFIED)
+        # Forget archives that no longer exist.
+        verified = dict((name, verified[name]) for name in names
+                        if name in verified)
+        sample = sample_archives(names, verified, args.verify)
+        start = time.time()
+        failed = 0
+        entries = 0
+        for archive_name, count, error, seconds in verify_archives(sample,
+                                                                   JOBS):
+            if error:
+                print 'Archive %s failed: %s' % (archive_name, error)
+                failed += 1
+            else:
+                print 'Archive %s OK: %d entries in %.1f seconds' % (
+                    archive_name, count, seconds)
+                verified[archive_name] = time.time()
+                entries += count
+        save_cache(VERIFIED, verified)
+        print 'Verified %d of %d archives (%d entries, %.1f entries/s), %d ' \
+              'failed.' % (len(sample) - failed, len(names), entries,
+                           entries / max(time.time() - start, 0.001), failed)
+        if failed:
             sys.exit(2)
+        sys.exit()
+
+    # If the user did not request deletion only, perform the backups.
+    if not args.remove and not args.dry_run:
+        # Load the results of previous permission scans, if requested.
+        if DEEP_PERMISSION_CHECK:
+            SCAN_RESULTS = load_cache(SCAN_CACHE)
+        # Load the sizes of the archives, to estimate the time left.
+        if PROGRESS_BYTES:
+            PROGRESS_RESULTS = load_cache(PROGRESS_SIZES)
+        # If the user specified a single archive, only execute that one.
+        if args.archive:
+            if args.archive not in BACKUPS:
+                print 'Archive %s is not configured.' % args.archive
+                sys.exit(2)
+            backups = {args.archive: BACKUPS[args.archive]}
+        # If the user did not specify a single archive, execute all of them.
         else:
-            create_archive(archive_name, BACKUPS[args.archive])
-    # If the user did not specify a single archive, execute all of them.
-    else:
-        for archive, contents in BACKUPS.items():
-            archive_name = prepare_archive(archive, contents)
-            if archive_name:
-                create_archive(archive_name, contents)
+            backups = dict(BACKUPS)
 
-# Look for any old backups to delete, if requested.
-if MAXIMUM_AGE:
-    now = datetime.datetime.now()
-    maximum_timedelta = convert_to_timedelta(MAXIMUM_AGE)
-    # Create an empty list to hold the aged archives.
-    aged = []
-    # For each archive, if the difference between the current date and the
-    # archive date is greater than the maximum allowed age, add it to the list
-    # of archives to be deleted.
-    archives = list_archives()
-    if archives:
-        for archive in archives:
-            archive = archive.strip().partition('\t')
-            name =  archive[0]
-            date = datetime.datetime.strptime(archive[-1], '%Y-%m-%d %H:%M:%S')
-            if (now - date) > maximum_timedelta:
-                aged.append(name)
-    # Delete any aged archives.
-    if aged:
-        delete_archives(aged)
+        # Skip any archives whose contents have not changed, if requested.
+        if SKIP_UNCHANGED:
+            FINGERPRINT_RESULTS = load_cache(FINGERPRINTS)
+            fingerprints = {}
+            skipped = []
+            start = time.time()
+            for archive, contents in sorted(backups.items()):
+                fingerprint = fingerprint_tree(contents.strip().split(),
+                                               SCAN_JOBS)
+                previous = FINGERPRINT_RESULTS.get(archive)
+                if fingerprint and previous and \
+                        previous['fingerprint'] == fingerprint:
+                    skipped.append(archive)
+                    del backups[archive]
+                fingerprints[archive] = fingerprint
+            if skipped:
+                saved = sum([FINGERPRINT_RESULTS[archive]['seconds']
+                             for archive in skipped])
+                print 'Skipped %d unchanged archives in %.1f seconds, ' \
+                      'saving about %.1f seconds.' % (
+                          len(skipped), time.time() - start, saved)
+
+        # Failures are collected so that one archive cannot stop the others.
+        failed = []
+        created = []
+        for archive, archive_name, error, seconds in create_archives(backups,
+                                                                     JOBS):
+            if error:
+                print 'Archive %s failed: %s' % (archive, error)
+                failed.append(archive)
+            elif not archive_name:
+                print 'Archive %s skipped: permission check failed' % archive
+            else:
+                created.append(archive_name)
+                if SKIP_UNCHANGED and fingerprints[archive]:
+                    FINGERPRINT_RESULTS[archive] = {
+                        'fingerprint': fingerprints[archive],
+                        'archive': archive_name,
+                        'seconds': seconds,
+                    }
+        update_index(created=created)
+        # Save the results of the permission scans, fingerprints and sizes
+        # for the next run.
+        if DEEP_PERMISSION_CHECK:
+            save_cache(SCAN_CACHE, SCAN_RESULTS)
+        if SKIP_UNCHANGED:
+            save_cache(FINGERPRINTS, FINGERPRINT_RESULTS)
+        if PROGRESS_BYTES:
+            save_cache(PROGRESS_SIZES, PROGRESS_RESULTS)
+        if failed:
+            sys.exit(2)
+
+    # Look for any old backups to delete, if requested.
+    keep = {'hourly': KEEP_HOURLY, 'daily': KEEP_DAILY, 'weekly': KEEP_WEEKLY,
+            'monthly': KEEP_MONTHLY, 'yearly': KEEP_YEARLY}
+    if MAXIMUM_AGE or any(keep.values()):
+        archives = load_archives(args.sync) or []
+        if any(keep.values()):
+            plan = plan_by_retention(archives, BACKUPS.keys(), keep)
+        else:
+            plan = plan_by_age(archives, MAXIMUM_AGE)
+        # Never delete the most recent archive of an entry that is being
+        # skipped because it has not changed, as there will be no newer
+        # archive.
+        if SKIP_UNCHANGED:
+            latest = set([result['archive']
+                          for result in load_cache(FINGERPRINTS).values()])
+            for i, (name, reasons) in enumerate(plan):
+                if not reasons and name in latest:
+                    plan[i] = (name, ['unchanged'])
+        aged = [name for name, reasons in plan if not reasons]
+        # Print the plan instead of deleting anything, if requested.
+        if args.dry_run:
+            for name, reasons in sorted(plan):
+                if reasons:
+                    print 'keep\t%s\t(%s)' % (name, ', '.join(reasons))
+                else:
+                    print 'delete\t%s' % name
+        # Delete any aged archives.
+        elif aged:
+            failed = delete_archives_in_batches(aged, DELETE_BATCH_SIZE,
+                                                DELETE_JOBS)
+            for batch, error in failed:
+                print 'Could not delete %d archives: %s' % (len(batch), error)
+            if failed:
+                sys.exit(2)
+    # Rebuild the index if requested, even if it was not needed for pruning.
+    elif args.sync and INDEX:
+        load_archives(sync=True)
+
+
+if __name__ == '__main__':
+    main()
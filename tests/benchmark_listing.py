@@ -0,0 +1,150 @@
+"""
+Benchmark the parsing of archive listings in tarsnapper.py against the
+strptime loop that it replaced. Run from the top of the repository with:
+
+    python tests/benchmark_listing.py [SIZE ...]
+
+Each size is a number of archives in a synthetic listing, half an hour apart.
+The default sizes are 10,000, 100,000 and 1,000,000. Before timing, the plans
+of the old and new code are checked to be identical.
+"""
+import datetime
+import imp
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+tarsnapper = imp.load_source('tarsnapper',
+                             os.path.join(ROOT, 'tarsnapper.py'))
+
+SIZES = (10000, 100000, 1000000)
+
+# The bases of the synthetic archives, and the policies to plan with.
+BASES = ('site', 'site.logs', 'mail')
+MAXIMUM_AGE = '30d'
+KEEP = {'hourly': 24, 'daily': 7, 'weekly': 4, 'monthly': 12, 'yearly': 5}
+
+
+def synthetic_listing(size):
+    """Return a listing of size archives, the newest dated now."""
+    now = datetime.datetime.now().replace(microsecond=0)
+    listing = []
+    for i in range(size):
+        date = now - datetime.timedelta(minutes=30 * i)
+        name = '%s.%s' % (BASES[i % len(BASES)],
+                          date.strftime('%Y-%m-%d_%H-%M-%S'))
+        listing.append('%s\t%s\n' % (name, date.strftime('%Y-%m-%d %H:%M:%S')))
+    return listing
+
+
+def old_plan_by_age(archives, maximum_age):
+    """Plan by age as tarsnapper did, with strptime on every line."""
+    now = datetime.datetime.now()
+    maximum_timedelta = tarsnapper.convert_to_timedelta(maximum_age)
+    plan = []
+    for archive in archives:
+        archive = archive.strip().partition('\t')
+        name = archive[0]
+        date = datetime.datetime.strptime(archive[-1], '%Y-%m-%d %H:%M:%S')
+        if (now - date) > maximum_timedelta:
+            plan.append((name, []))
+        else:
+            plan.append((name, ['maximum age']))
+    return plan
+
+
+def iso_week(date):
+    """Return the ISO year and week of a '%Y-%m-%d %H:%M:%S' date string."""
+    return datetime.date(int(date[:4]), int(date[5:7]),
+                         int(date[8:10])).isocalendar()[:2]
+
+OLD_RETENTION_PERIODS = (
+    ('hourly', lambda date: date[:13]),
+    ('daily', lambda date: date[:10]),
+    ('weekly', iso_week),
+    ('monthly', lambda date: date[:7]),
+    ('yearly', lambda date: date[:4]),
+)
+
+
+def old_plan_by_retention(archives, bases, keep):
+    """Plan by retention as tarsnapper did, slicing every date string."""
+    bases = set(bases)
+    plan = []
+    entries = []
+    for archive in archives:
+        name, _, date = archive.strip().partition('\t')
+        base = tarsnapper.archive_base(name, bases)
+        if base is None:
+            plan.append((name, ['unmanaged']))
+        else:
+            entries.append((base, date, name))
+    periods = [(period, function, keep[period])
+               for period, function in OLD_RETENTION_PERIODS
+               if keep.get(period)]
+    entries.sort(reverse=True)
+    current = None
+    for base, date, name in entries:
+        if base != current:
+            current = base
+            seen = dict((period, [None, 0]) for period, _, _ in periods)
+        reasons = []
+        for period, function, limit in periods:
+            state = seen[period]
+            if state[1] >= limit:
+                continue
+            key = function(date)
+            if key != state[0]:
+                state[0] = key
+                state[1] += 1
+                reasons.append(period)
+        plan.append((name, reasons))
+    return plan
+
+
+def best(function, runs):
+    """Return the shortest time taken by function over the given runs."""
+    times = []
+    for i in range(runs):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or SIZES
+    print '%10s %10s %10s %10s %10s %10s %10s' % (
+        'archives', 'strptime', 'parse', 'old age', 'new age',
+        'old keep', 'new keep')
+    for size in sizes:
+        listing = synthetic_listing(size)
+        # The cutoff moves with the clock, so compare the names kept rather
+        # than asking both planners for the same microsecond.
+        if (sorted([name for name, reasons in old_plan_by_age(
+                listing, MAXIMUM_AGE) if reasons]) !=
+                sorted([name for name, reasons in tarsnapper.plan_by_age(
+                    listing, MAXIMUM_AGE) if reasons])):
+            sys.exit('The plans by age differ for %d archives.' % (size))
+        if (old_plan_by_retention(listing, BASES, KEEP) !=
+                tarsnapper.plan_by_retention(listing, BASES, KEEP)):
+            sys.exit('The plans by retention differ for %d archives.' % (size))
+        runs = 1 if size >= 1000000 else 3
+
+        def strptime_loop():
+            for archive in listing:
+                datetime.datetime.strptime(archive.strip().partition('\t')[-1],
+                                           '%Y-%m-%d %H:%M:%S')
+        print '%10d %9.3fs %9.3fs %9.3fs %9.3fs %9.3fs %9.3fs' % (
+            size, best(strptime_loop, runs),
+            best(lambda: tarsnapper.parse_listing(listing), runs),
+            best(lambda: old_plan_by_age(listing, MAXIMUM_AGE), runs),
+            best(lambda: tarsnapper.plan_by_age(listing, MAXIMUM_AGE), runs),
+            best(lambda: old_plan_by_retention(listing, BASES, KEEP), runs),
+            best(lambda: tarsnapper.plan_by_retention(listing, BASES, KEEP),
+                 runs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+"""
+Tests for db-backup.py. Run from the top of the repository with:
+
+    python -m unittest discover -s tests
+"""
+import imp
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+db_backup = imp.load_source('db_backup', os.path.join(ROOT, 'db-backup.py'))
+tarsnapper = imp.load_source('tarsnapper',
+                             os.path.join(ROOT, 'tarsnapper.py'))
+
+# Send backups to the stand-ins for sftp, rsync, the AWS CLI and tarsnap.
+STUBS = os.path.join(ROOT, 'tests')
+
+
+class DestinationTest(unittest.TestCase):
+    """Send a backup to every kind of destination, through the stubs."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.remote = os.path.join(self.directory, 'remote')
+        os.mkdir(self.remote)
+        os.environ['DESTINATION_STUB'] = self.remote
+        os.environ['TARSNAP_STUB'] = self.directory
+        self.saved = dict((name, getattr(db_backup, name)) for name in
+                          ('SFTP', 'RSYNC', 'AWS', 'TARSNAPPER_MODULE',
+                           'DESTINATION_DELAY', 'QUIET'))
+        db_backup.SFTP = os.path.join(STUBS, 'sftp-stub')
+        db_backup.RSYNC = os.path.join(STUBS, 'rsync-stub')
+        db_backup.AWS = os.path.join(STUBS, 'aws-stub')
+        db_backup.TARSNAPPER_MODULE = tarsnapper
+        db_backup.DESTINATION_DELAY = 0
+        db_backup.QUIET = True
+        self.saved_tarsnapper = dict((name, getattr(tarsnapper, name))
+                                     for name in ('TARSNAP', 'INDEX',
+                                                  'SUFFIX'))
+        tarsnapper.TARSNAP = os.path.join(STUBS, 'tarsnap-stub')
+        tarsnapper.INDEX = os.path.join(self.directory, 'index')
+        tarsnapper.SUFFIX = False
+        tarsnapper.write_index([], time.time())
+        self.backup = os.path.join(self.directory, 'db.2016-01-01.mysql.gz')
+        f = open(self.backup, 'w')
+        f.write('backup\n')
+        f.close()
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(db_backup, name, value)
+        for name, value in self.saved_tarsnapper.items():
+            setattr(tarsnapper, name, value)
+        shutil.rmtree(self.directory)
+
+    def sent(self, *parts):
+        """Return whether the backup arrived at the given remote path."""
+        path = os.path.join(self.remote, *parts + ('db.2016-01-01.mysql.gz',))
+        return os.path.isfile(path)
+
+    def test_deliver(self):
+        """A backup is sent to every destination at once."""
+        destinations = ['sftp://host/backups', 'ssh://host:2222/copies',
+                        'rsync://host/module/db', 's3://bucket/db',
+                        os.path.join(self.directory, 'local')]
+        sent, errors = db_backup.deliver(self.backup, 'db',
+                                         destinations=destinations)
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(sent), sorted(destinations))
+        self.assertTrue(self.sent('host', 'backups'))
+        self.assertTrue(self.sent('host', 'copies'))
+        self.assertTrue(self.sent('host', 'module', 'db'))
+        self.assertTrue(self.sent('bucket', 'db'))
+        self.assertTrue(os.path.isfile(os.path.join(
+            self.directory, 'local', 'db.2016-01-01.mysql.gz')))
+
+    def test_retry(self):
+        """A failed upload is tried again, up to DESTINATION_ATTEMPTS."""
+        f = open(os.path.join(self.remote, 'fail'), 'w')
+        f.write('%d\n' % (db_backup.DESTINATION_ATTEMPTS - 1))
+        f.close()
+        sent, errors = db_backup.deliver(self.backup, 'db',
+                                         destinations=['s3://bucket'])
+        self.assertEqual(errors, [])
+        self.assertTrue(self.sent('bucket'))
+
+    def test_tarsnap_index(self):
+        """Archives sent to Tarsnap at the same time all reach the index."""
+        destinations = ['tarsnap:db%d' % i for i in range(8)]
+        sent, errors = db_backup.deliver(self.backup, 'db',
+                                         destinations=destinations)
+        self.assertEqual(errors, [])
+        names = sorted([archive.split('\t')[0] for archive in
+                        tarsnapper.read_index()])
+        self.assertEqual(names, sorted(['db%d' % i for i in range(8)]))
+
+    def test_tarsnap_metrics(self):
+        """A backup in a directory with a space is archived, with metrics."""
+        directory = os.path.join(self.directory, 'with space')
+        os.mkdir(directory)
+        backup = os.path.join(directory, 'db.2016-01-01.mysql.gz')
+        shutil.copy(self.backup, backup)
+        del db_backup.METRICS[:]
+        sent, errors = db_backup.deliver(backup, 'db', host='db1',
+                                         destinations=['tarsnap:db'])
+        self.assertEqual(errors, [])
+        log = open(os.path.join(self.directory, 'log')).read()
+        self.assertTrue('-C %s db.2016-01-01.mysql.gz' % (directory) in log)
+        stages = dict((metric['stage'], metric) for metric in
+                      db_backup.METRICS)
+        del db_backup.METRICS[:]
+        self.assertEqual(stages['tarsnap create']['bytes_out'], 512)
+        self.assertEqual(stages['tarsnap create']['host'], 'db1')
+        self.assertEqual(tarsnapper.METRICS, [])
+
+
+class BatchTest(unittest.TestCase):
+
+    def test_host_without_jobs(self):
+        """A host section without a job limit keeps the default limit."""
+        directory = tempfile.mkdtemp()
+        config = os.path.join(directory, 'batch.conf')
+        f = open(config, 'w')
+        f.write('[Settings]\ndirectory: %s\ntype: postgresql\n'
+                '[Host db1]\n[Host db2]\njobs: 3\n[wiki]\nhost: db1\n'
+                % (directory))
+        f.close()
+        try:
+            databases, host_jobs = db_backup.read_batch(config)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(host_jobs, {'db2': 3})
+        self.assertEqual([options['host'] for options in databases], ['db1'])
+
+
+class CompressionTest(unittest.TestCase):
+
+    def test_levels(self):
+        """Compression levels are checked, and high zstd levels allowed."""
+        self.assertEqual(db_backup.compressor_command('gzip:9')[-1], '-9')
+        self.assertEqual(db_backup.compressor_command('zstd:22')[-2:],
+                         ['--ultra', '-22'])
+        for compression in ('zstd:fast', 'gzip:12', 'xz:-1'):
+            self.assertRaises(db_backup.BackupError,
+                              db_backup.compressor_command, compression)
+
+
+class StoreTest(unittest.TestCase):
+    """Move dumps into the store and rebuild them."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = os.path.join(self.directory, 'store')
+        self.saved = (db_backup.QUIET, db_backup.STORE_CHUNK_SIZE)
+        db_backup.QUIET = True
+        db_backup.STORE_CHUNK_SIZE = 1024
+
+    def tearDown(self):
+        db_backup.QUIET, db_backup.STORE_CHUNK_SIZE = self.saved
+        shutil.rmtree(self.directory)
+
+    def write_dump(self, name, lines):
+        """Write a dump of the given lines, and return its path and data."""
+        data = ''.join(lines)
+        path = os.path.join(self.directory, name)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path, data
+
+    def read(self, path):
+        """Return the contents of a file."""
+        f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_round_trip(self):
+        """A stored dump is rebuilt byte for byte, sharing chunks."""
+        generator = random.Random(1)
+        lines = ['INSERT INTO t VALUES (%d, %r);\n' %
+                 (i, generator.random()) for i in range(5000)]
+        # The second day's dump changes one row and has no final newline.
+        changed = lines[:]
+        changed[2500] = 'INSERT INTO t VALUES (2500, 0);\n'
+        changed[-1] = changed[-1].rstrip('\n')
+        dumps = [self.write_dump('db.2016-01-01.mysql', lines),
+                 self.write_dump('db.2016-01-02.mysql', changed)]
+        recipes = []
+        for path, data in dumps:
+            recipes.append(db_backup.store_backup(path, self.store, 'db'))
+            self.assertFalse(os.path.exists(path))
+        stored = sum([len(files) for root, dirs, files in
+                      os.walk(self.store)])
+        for recipe, (path, data) in zip(recipes, dumps):
+            self.assertEqual(db_backup.restore_backup(recipe, self.store),
+                             path)
+            self.assertEqual(self.read(path), data)
+        # Most of the chunks of the second dump are shared with the first.
+        first = len(open(recipes[0]).readlines())
+        self.assertTrue(stored < first * 1.5)
+
+    def test_damaged_chunk(self):
+        """A damaged chunk stops the dump from being rebuilt."""
+        path, data = self.write_dump('db.2016-01-01.mysql',
+                                     ['line %d\n' % i for i in range(1000)])
+        recipe = db_backup.store_backup(path, self.store, 'db')
+        name = open(recipe).readline().split()[0]
+        f = open(db_backup.chunk_path(self.store, name), 'wb')
+        f.write('damaged')
+        f.close()
+        self.assertRaises(db_backup.BackupError, db_backup.restore_backup,
+                          recipe, self.store)
+        self.assertFalse(os.path.exists(path))
+
+
+class ResumeTest(unittest.TestCase):
+    """Fail to deliver a backup, and then resume it."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.remote = os.path.join(self.directory, 'remote')
+        os.mkdir(self.remote)
+        os.environ['DESTINATION_STUB'] = self.remote
+        os.environ['GNUPGHOME'] = tempfile.mkdtemp()
+        self.saved = dict((name, getattr(db_backup, name)) for name in
+                          ('MYSQLDUMP', 'AWS', 'DESTINATION_DELAY', 'QUIET'))
+        db_backup.MYSQLDUMP = os.path.join(STUBS, 'mysqldump-stub')
+        db_backup.AWS = os.path.join(STUBS, 'aws-stub')
+        db_backup.DESTINATION_DELAY = 0
+        db_backup.QUIET = True
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(db_backup, name, value)
+        # The GnuPG agent may still be removing its sockets.
+        shutil.rmtree(os.environ.pop('GNUPGHOME'), True)
+        shutil.rmtree(self.directory)
+
+    def dumps(self):
+        """Return how many times the database was dumped."""
+        log = open(os.path.join(self.remote, 'log')).read()
+        return log.count('mysqldump ')
+
+    def resume(self, **options):
+        """
+        Back up the database with a failing delivery, check the hashes in the
+        journal, and resume. Return the name of the file that was delivered.
+        """
+        f = open(os.path.join(self.remote, 'fail'), 'w')
+        f.write('%d\n' % (db_backup.DESTINATION_ATTEMPTS))
+        f.close()
+        backup = lambda resume: db_backup.backup_database(
+            'mysql', 'db', 'localhost', 'db', 'password', self.directory,
+            compression='gzip', resume=resume,
+            destinations=['s3://bucket'], **options)
+        self.assertRaises(db_backup.BackupError, backup, False)
+        journal = db_backup.load_journal(os.path.join(self.directory,
+                                                      'db.mysql.journal'))
+        self.assertTrue('delivered' not in journal['stages'])
+        for stage in journal['stages'].values():
+            for name, (algorithm, hexdigest) in stage['files'].items():
+                self.assertEqual(db_backup.file_digest(
+                    os.path.join(self.directory, name), algorithm), hexdigest)
+        backup(True)
+        self.assertEqual(self.dumps(), 1)
+        self.assertFalse(os.path.exists(os.path.join(self.directory,
+                                                     'db.mysql.journal')))
+        return os.listdir(os.path.join(self.remote, 'bucket'))
+
+    def test_resume(self):
+        """A resumed backup is delivered without dumping it again."""
+        sent = self.resume(key='secret')
+        self.assertEqual(sent, ['db.%s.tar.gz.gpg' % (db_backup.TODAY)])
+
+    def test_resume_stream(self):
+        """A resumed streamed backup is delivered without dumping it again."""
+        sent = self.resume(stream=True)
+        self.assertEqual(sent, ['db.%s.mysql.gz' % (db_backup.TODAY)])
+
+
+class MySQLTest(unittest.TestCase):
+
+    def test_tables_refused(self):
+        """Tables dumps are refused unless per-table snapshots are allowed."""
+        directory = tempfile.mkdtemp()
+        try:
+            self.assertRaises(db_backup.BackupError, db_backup.backup_database,
+                              'mysql', 'db', 'localhost', 'db', 'password',
+                              directory, mysql_format='tables')
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+"""
+Tests for tarsnapper.py. Run from the top of the repository with:
+
+    python -m unittest discover -s tests
+"""
+import imp
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+tarsnapper = imp.load_source('tarsnapper',
+                             os.path.join(ROOT, 'tarsnapper.py'))
+
+# Run tarsnapper against the stand-in for tarsnap.
+STUB = os.path.join(ROOT, 'tests', 'tarsnap-stub')
+
+
+class StubTestCase(unittest.TestCase):
+    """Point tarsnapper at the tarsnap stub, with its own directory."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.environ['TARSNAP_STUB'] = self.directory
+        self.saved = dict((name, getattr(tarsnapper, name)) for name in
+                          ('TARSNAP', 'INDEX', 'SUFFIX'))
+        tarsnapper.TARSNAP = STUB
+        tarsnapper.INDEX = os.path.join(self.directory, 'index')
+        tarsnapper.SUFFIX = False
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(tarsnapper, name, value)
+        shutil.rmtree(self.directory)
+
+    def fail_next(self, count):
+        """Make the stub fail the next count commands."""
+        f = open(os.path.join(self.directory, 'fail'), 'w')
+        f.write('%d\n' % count)
+        f.close()
+
+    def stub_archives(self):
+        """Return the names of the archives that the stub holds."""
+        f = open(os.path.join(self.directory, 'archives'))
+        try:
+            return sorted([line.split('\t')[0] for line in f])
+        finally:
+            f.close()
+
+    def add_archives(self, names):
+        """Create the given archives in the stub."""
+        f = open(os.path.join(self.directory, 'archives'), 'a')
+        for name in names:
+            f.write('%s\t2016-01-01 00:00:00\n' % name)
+        f.close()
+
+
+class CreateTest(StubTestCase):
+
+    def test_parallel_failure(self):
+        """A failed archive does not stop the others from being created."""
+        self.fail_next(1)
+        backups = dict((name, self.directory) for name in ('a', 'b', 'c'))
+        results = tarsnapper.create_archives(backups, 3)
+        errors = [error for archive, name, error, seconds in results if error]
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(len(self.stub_archives()), 2)
+
+    def test_without_main(self):
+        """Archives may be created without running main() first."""
+        saved = (tarsnapper.DEEP_PERMISSION_CHECK, tarsnapper.PROGRESS_BYTES)
+        tarsnapper.DEEP_PERMISSION_CHECK = True
+        tarsnapper.PROGRESS_BYTES = 1024
+        try:
+            archive, name, error, seconds = tarsnapper.run_archive(
+                ('site', self.directory))
+        finally:
+            (tarsnapper.DEEP_PERMISSION_CHECK,
+             tarsnapper.PROGRESS_BYTES) = saved
+        self.assertEqual(error, None)
+        self.assertEqual(self.stub_archives(), [name])
+
+    def test_new_data(self):
+        """The new data that tarsnap uploads is recorded for each archive."""
+        del tarsnapper.METRICS[:]
+        tarsnapper.create_archive('site', [self.directory], label='site')
+        metric = tarsnapper.METRICS.pop()
+        self.assertEqual((metric['stage'], metric['bytes_out']),
+                         ('create', 512))
+
+    def test_parse_stats(self):
+        """The size of the new data is read from plain or humanized stats."""
+        self.assertEqual(tarsnapper.parse_stats(
+            'New data                                     1024   512\n'), 512)
+        self.assertEqual(tarsnapper.parse_stats(
+            'New data                             1.1 MB     512 kB\n'),
+            512000)
+        self.assertEqual(tarsnapper.parse_stats(
+            'This archive                                 2048  1024\n'), 0)
+        self.assertEqual(tarsnapper.parse_stats('site/file\n'), None)
+
+
+class DeleteTest(StubTestCase):
+
+    def test_batches(self):
+        """Archives are deleted in batches and removed from the index."""
+        names = ['site.2016-01-%02d' % day for day in range(1, 8)]
+        self.add_archives(names)
+        tarsnapper.load_archives(sync=True)
+        failed = tarsnapper.delete_archives_in_batches(names[:5], 2, 2)
+        self.assertEqual(failed, [])
+        self.assertEqual(self.stub_archives(), names[5:])
+        self.assertEqual(sorted([archive.split('\t')[0] for archive in
+                                 tarsnapper.read_index()]), names[5:])
+
+    def test_failed_batch(self):
+        """A failed batch invalidates the index, so the next run relists."""
+        names = ['site.2016-01-%02d' % day for day in range(1, 5)]
+        self.add_archives(names)
+        tarsnapper.load_archives(sync=True)
+        # The second archive is missing, so tarsnap deletes the first and
+        # then fails.
+        self.add_archives(['site.2016-01-09'])
+        failed = tarsnapper.delete_archives_in_batches(
+            ['site.2016-01-01', 'site.2016-01-08', 'site.2016-01-02'], 3, 1)
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(tarsnapper.read_index(), None)
+        archives = tarsnapper.load_archives()
+        self.assertEqual(sorted([archive.split('\t')[0] for archive in
+                                 archives]), self.stub_archives())
+
+
+class WalkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, 'a', 'b'))
+        open(os.path.join(self.directory, 'a', 'file'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_no_threads_left(self):
+        """The walking threads are stopped once each walk is over."""
+        before = threading.active_count()
+        for i in range(5):
+            tarsnapper.scan_tree([self.directory], {}, 4)
+            tarsnapper.fingerprint_tree([self.directory], 4)
+        self.assertEqual(threading.active_count(), before)
+
+    def test_unexpected_error(self):
+        """An error other than OSError is raised, rather than hanging."""
+        def visit(path):
+            raise ValueError(path)
+        self.assertRaises(ValueError, tarsnapper.parallel_walk,
+                          [self.directory, self.directory], visit, 1)
+
+
+class ConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved = tarsnapper.DEFAULT_CONFIG
+        tarsnapper.DEFAULT_CONFIG = self.write_config('default.conf')
+
+    def tearDown(self):
+        tarsnapper.read_config(tarsnapper.DEFAULT_CONFIG)
+        tarsnapper.DEFAULT_CONFIG = self.saved
+        shutil.rmtree(self.directory)
+
+    def write_config(self, name, settings=''):
+        """Write a configuration file, and return its path."""
+        path = os.path.join(self.directory, name)
+        f = open(path, 'w')
+        f.write('[Settings]\n%s' % (settings))
+        f.close()
+        return path
+
+    def test_caches_apart(self):
+        """Each configuration file has its own caches, unless it sets them."""
+        home = self.write_config('home.conf')
+        work = self.write_config('work.conf', 'index: /tmp/index\n')
+        tarsnapper.read_config(home)
+        home_caches = (tarsnapper.INDEX, tarsnapper.FINGERPRINTS)
+        # Reading the file again gives the same caches.
+        tarsnapper.read_config(home)
+        self.assertEqual((tarsnapper.INDEX, tarsnapper.FINGERPRINTS),
+                         home_caches)
+        tarsnapper.read_config(work)
+        self.assertEqual(tarsnapper.INDEX, '/tmp/index')
+        self.assertNotEqual(tarsnapper.FINGERPRINTS, home_caches[1])
+        for cache in home_caches + (tarsnapper.FINGERPRINTS,):
+            self.assertFalse(cache in tarsnapper.DEFAULT_CACHES)
+        tarsnapper.read_config(tarsnapper.DEFAULT_CONFIG)
+        self.assertEqual(tarsnapper.INDEX, tarsnapper.DEFAULT_CACHES[2])
+
+
+class RetentionTest(unittest.TestCase):
+
+    def test_nested_bases(self):
+        """Archives of a base are not grouped under a shorter base."""
+        bases = ['site', 'site.logs']
+        self.assertEqual(tarsnapper.archive_base('site.logs.2016-01-03',
+                                                 bases), 'site.logs')
+        self.assertEqual(tarsnapper.archive_base('site.2016-01-03', bases),
+                         'site')
+        archives = []
+        for day in range(1, 6):
+            date = '2016-01-%02d 00:00:00' % day
+            for base in bases:
+                archives.append('%s.2016-01-%02d\t%s' % (base, day, date))
+        plan = dict(tarsnapper.plan_by_retention(archives, bases,
+                                                 {'daily': 3}))
+        kept = sorted([name for name, reasons in plan.items() if reasons])
+        self.assertEqual(kept, [
+            'site.2016-01-03', 'site.2016-01-04', 'site.2016-01-05',
+            'site.logs.2016-01-03', 'site.logs.2016-01-04',
+            'site.logs.2016-01-05'])
+
+    def test_periods(self):
+        """Weeks run from Monday, across years, and months from the first."""
+        archives = ['site.2015-12-%02d\t2015-12-%02d 12:00:00' % (day, day)
+                    for day in range(20, 32)]
+        archives += ['site.2016-01-%02d\t2016-01-%02d 12:00:00' % (day, day)
+                     for day in range(1, 11)]
+        archives.append('other\t2016-01-10 12:00:00')
+        plan = dict(tarsnapper.plan_by_retention(
+            archives, ['site'], {'weekly': 5, 'monthly': 3}))
+        self.assertEqual(plan['other'], ['unmanaged'])
+        kept = sorted([(name, reasons) for name, reasons in plan.items()
+                       if reasons and name != 'other'])
+        self.assertEqual(kept, [
+            ('site.2015-12-20', ['weekly']),
+            ('site.2015-12-27', ['weekly']),
+            ('site.2015-12-31', ['monthly']),
+            ('site.2016-01-03', ['weekly']),
+            ('site.2016-01-10', ['weekly', 'monthly'])])
+
+
+if __name__ == '__main__':
+    unittest.main()